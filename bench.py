@@ -0,0 +1,233 @@
+"""
+Benchmarks of the stages of the composer on synthetic CZI files, without the gui.
+
+Each stage is timed (best of --repeat runs) and its peak traced memory is
+recorded. Results are compared against a baseline json file, and stages that
+got slower or larger than the tolerance allows are reported as regressions.
+
+    python bench.py [--size 4096x4096] [--bits 12] [--channels 3] [--depth 16]
+                    [--save-baseline] [--baseline bench_baseline.json]
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import numpy as npy
+from PIL import Image
+
+import czicore
+
+# size of the image canvas of the gui
+PREVIEW_SIZE = (800, 800)
+
+def segment(sid, payload):
+    """
+    Return a ZISRAW segment: a 32-byte header and its payload, padded to 32 bytes.
+    """
+    allocated = -(-len(payload) // 32) * 32
+    return struct.pack('<16sqq', sid.encode(), allocated, len(payload)) + payload + \
+           b'\0' * (allocated - len(payload))
+
+def directory_entry(pixel_type, position, dims):
+    """
+    Return a DV directory entry of a subblock at file 'position', with dims
+    as (dimension, start, size, stored size).
+    """
+    entry = struct.pack('<2siqiiBB4si', b'DV', pixel_type, position, 0, 0, 0, 0, b'\0' * 4, len(dims))
+    for dimension, start, size, stored_size in dims:
+        entry += struct.pack('<4siifi', dimension.encode(), start, size, float(start), stored_size)
+    return entry
+
+def write_czi(path, width, height, channels = 3, depth = 1, times = 1, bits = 16, tile = 1024, seed = 0):
+    """
+    Write an uncompressed CZI file of noisy gradients, cut into 'tile' sized
+    subblocks, with display settings for each channel.
+    """
+    dtype = npy.uint8 if bits <= 8 else npy.uint16
+    pixel_type = 0 if bits <= 8 else 1
+    maximum = (1 << bits) - 1
+    rng = npy.random.default_rng(seed)
+    gradient = npy.add.outer(npy.linspace(0, 0.5, height), npy.linspace(0, 0.5, width))
+
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 512)
+        entries = []
+        for t in range(times):
+            for z in range(depth):
+                for c in range(channels):
+                    level = gradient * (1 - abs(z - depth / 2) / depth) * (c + 1) / channels
+                    noise = rng.random((height, width), npy.float32) * 0.25
+                    plane = ((level + noise) * maximum).clip(0, maximum).astype(dtype)
+                    for y in range(0, height, tile):
+                        for x in range(0, width, tile):
+                            data = npy.ascontiguousarray(plane[y:y + tile, x:x + tile])
+                            dims = [('X', x, data.shape[1], data.shape[1]),
+                                    ('Y', y, data.shape[0], data.shape[0]),
+                                    ('C', c, 1, 1), ('Z', z, 1, 1), ('T', t, 1, 1),
+                                    ('M', len(entries), 1, 1)]
+                            entry = directory_entry(pixel_type, f.tell(), dims)
+                            header = struct.pack('<iiq', 0, 0, data.nbytes) + entry
+                            f.write(segment('ZISRAWSUBBLOCK', header + b'\0' * max(0, 240 - len(entry)) +
+                                            data.tobytes()))
+                            entries += [entry]
+
+        colors = ['FF0000', '00FF00', '0000FF', 'FFFFFF']
+        settings = ''.join(
+            '<Channel Id="Channel:%d"><ShortName>Channel %d</ShortName><Color>#FF%s</Color>'
+            '<Low>0</Low><High>1</High><Gamma>1</Gamma><IsSelected>true</IsSelected></Channel>'
+            % (c, c, colors[c % len(colors)]) for c in range(channels))
+        xml = ('<ImageDocument><Metadata><Information><Image><PixelType>%s</PixelType>'
+               '<ComponentBitCount>%d</ComponentBitCount><SizeX>%d</SizeX><SizeY>%d</SizeY>'
+               '<SizeC>%d</SizeC><SizeZ>%d</SizeZ><SizeT>%d</SizeT></Image></Information>'
+               '<DisplaySetting><Channels>%s</Channels></DisplaySetting></Metadata></ImageDocument>'
+               % ('Gray8' if bits <= 8 else 'Gray16', bits, width, height, channels, depth, times,
+                  settings)).encode()
+        metadata = f.tell()
+        f.write(segment('ZISRAWMETADATA', struct.pack('<ii', len(xml), 0) + b'\0' * 248 + xml))
+        directory = f.tell()
+        f.write(segment('ZISRAWDIRECTORY', struct.pack('<i', len(entries)) + b'\0' * 124 + b''.join(entries)))
+
+        guid = uuid.uuid4().bytes
+        header = struct.pack('<iiii16s16siqqiq', 1, 0, 0, 0, guid, guid, 0, directory, metadata, 0, 0)
+        f.seek(0)
+        f.write(segment('ZISRAWFILE', header + b'\0' * (480 - len(header))))
+
+def view_state(document, merged, view = None):
+    """
+    Return the state the gui starts with: the display settings of the file, all
+    depth slices merged by maximum or the middle one.
+    """
+    channels = tuple(czicore.ChannelState(cid, setting.low, setting.high, setting.color,
+                                          setting.gamma, setting.visible)
+                     for cid, setting in enumerate(document.channel_settings()))
+    return czicore.ViewState(view, merged, document.depth // 2, 0, document.depth - 1,
+                             'Maximum (Lighten)', channels)
+
+def fit_view(document):
+    height, width = document.plane_shape()
+    cw, ch = PREVIEW_SIZE
+    scale = max(width / cw, height / ch)
+    return ((width - cw * scale) / 2, (height - ch * scale) / 2), scale, PREVIEW_SIZE
+
+def stages(path, output):
+    """
+    Return (name, run) pairs; each run opens the file afresh, so no stage is
+    helped by the caches of the one before.
+    """
+    def opened(run):
+        def stage():
+            # caches shared by all documents and renderers outlive a document
+            czicore.CziMetadata.cache.clear()
+            czicore.Renderer.frames.clear()
+            document = czicore.CziDocument(path)
+            try:
+                run(document)
+            finally:
+                document.close()
+        return stage
+
+    def save(document):
+        rgb, planes = czicore.Renderer(document).render(view_state(document, False))
+        czicore.save_export(os.path.join(output, 'export.png'), Image.fromarray(rgb), planes)
+
+    return [
+        ('open_file', opened(lambda document: document.channel_settings())),
+        ('update_image', opened(lambda document: czicore.Renderer(document).render(
+            view_state(document, False, fit_view(document))))),
+        ('update_merged', opened(lambda document: czicore.Renderer(document).render(
+            view_state(document, True, fit_view(document))))),
+        ('histogram', opened(lambda document: czicore.Histograms(document).slice(document.depth // 2))),
+        ('save_file', opened(save)),
+        ('save_stack', opened(lambda document: czicore.StackWriter(document).write(
+            os.path.join(output, 'stack.ome.tif')))),
+    ]
+
+def measure(run, repeat):
+    """
+    Return the best time in seconds and the highest traced memory in bytes of 'repeat' runs.
+    """
+    best, peak = float('inf'), 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        began = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - began)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return best, peak
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the composer on a synthetic CZI file.')
+    parser.add_argument('--size', default = '4096x4096', help = 'plane size, WIDTHxHEIGHT')
+    parser.add_argument('--bits', type = int, default = 12, choices = (8, 12, 16))
+    parser.add_argument('--channels', type = int, default = 3)
+    parser.add_argument('--depth', type = int, default = 16)
+    parser.add_argument('--times', type = int, default = 1)
+    parser.add_argument('--tile', type = int, default = 1024, help = 'subblock size in pixels')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--only', nargs = '+', metavar = 'STAGE', help = 'stages to run')
+    parser.add_argument('--baseline', default = 'bench_baseline.json')
+    parser.add_argument('--save-baseline', action = 'store_true',
+                        help = 'store these results as the baseline instead of comparing')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'allowed slowdown and memory growth over the baseline (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    width, height = (int(n) for n in args.size.lower().split('x'))
+    config = {'size': [width, height], 'bits': args.bits, 'channels': args.channels,
+              'depth': args.depth, 'times': args.times, 'tile': args.tile}
+
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print('baseline %s was taken with %s, not compared' % (args.baseline, baseline.get('config')))
+            baseline = {}
+
+    results = {}
+    regressions = []
+    with tempfile.TemporaryDirectory() as output:
+        path = os.path.join(output, 'bench.czi')
+        began = time.perf_counter()
+        write_czi(path, width, height, args.channels, args.depth, args.times, args.bits, args.tile)
+        print('%dx%d, %d-bit, %d channels, %d slices, %d time points: written in %.1f s'
+              % (width, height, args.bits, args.channels, args.depth, args.times,
+                 time.perf_counter() - began))
+
+        print('%-14s %10s %12s' % ('stage', 'seconds', 'peak MB'))
+        for name, run in stages(path, output):
+            if args.only and name not in args.only:
+                continue
+            seconds, peak = measure(run, args.repeat)
+            results[name] = {'seconds': seconds, 'peak': peak}
+
+            line = '%-14s %10.3f %12.1f' % (name, seconds, peak / 2 ** 20)
+            reference = baseline.get('stages', {}).get(name)
+            if reference != None:
+                ratio = seconds / reference['seconds']
+                growth = peak / max(reference['peak'], 1)
+                line += '   %+6.0f%% time %+6.0f%% memory' % (100 * (ratio - 1), 100 * (growth - 1))
+                if ratio > 1 + args.tolerance or growth > 1 + args.tolerance:
+                    regressions += [name]
+                    line += '   REGRESSION'
+            print(line)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'config': config, 'stages': results}, f, indent = 2)
+        print('baseline saved to ' + args.baseline)
+    if len(regressions) > 0:
+        print('regressions: ' + ', '.join(regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
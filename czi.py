@@ -2,19 +2,18 @@ from tkinter import *
 from tkinter import ttk, font
 from tkinter import filedialog as fd
 from tkinter import colorchooser as colorchooser
+from tkinter import messagebox
 import ctypes
-
-import czifile
-from czifile import CziFile
-
-from xml.dom.minidom import parseString
-import xml.dom.minidom
+import queue
+import sys
+import threading
+import time
 
 import numpy as npy
-from PIL import Image, ImageTk, ImageDraw, ImageFont
+from PIL import Image, ImageTk
 
-ctypes.windll.shcore.SetProcessDpiAwareness(1)
-ScaleFactor=ctypes.windll.shcore.GetScaleFactorForDevice(0)
+from czicore import (BLEND_MODES, CACHE_DIRECTORY, ChannelState, CziDocument, Labels, Renderer,
+                     StackWriter, ViewState, batch, save_export, timings)
 
 class RangeSlider(Frame):
 
@@ -349,18 +348,342 @@ class RangeSlider(Frame):
         self.__entry_in['state'] = state
         self.__entry_out['state'] = state
 
+class RenderWorker:
+    """
+    Runs render jobs on a background thread and hands their results back to
+    the Tk event loop.
+
+    Jobs are submitted under a key; a job still waiting under the same key is
+    replaced, so only the newest state of each kind gets rendered. Results are
+    collected by polling from the Tk loop, which is the only thread allowed to
+    touch widgets.
+    """
+
+    def __init__(self, master, poll = 10):
+        self.master = master
+        self.poll = poll
+        self.condition = threading.Condition()
+        # key -> (job, done), waiting to run
+        self.pending = {}
+        self.running = False
+        self.finished = queue.Queue()
+        self.polling = None
+        self.thread = threading.Thread(target = self.__work, daemon = True)
+        self.thread.start()
+
+    def submit(self, key, job, done):
+        """
+        Run job() on the worker thread, then done(result) on the Tk thread.
+        """
+        with self.condition:
+            self.pending[key] = (job, done)
+            self.condition.notify()
+        if self.polling == None:
+            self.polling = self.master.after(self.poll, self.__collect)
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+                key = next(iter(self.pending))
+                job, done = self.pending.pop(key)
+                self.running = True
+            try:
+                self.finished.put((done, job(), None))
+            except Exception as e:
+                self.finished.put((done, None, e))
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def cancel(self, key):
+        """
+        Drop the job waiting under 'key', if any.
+        """
+        with self.condition:
+            self.pending.pop(key, None)
+
+    def wait(self):
+        """
+        Drop the waiting jobs and unreported results, and block until the running
+        job has finished.
+        """
+        with self.condition:
+            self.pending = {}
+            while self.running:
+                self.condition.wait()
+        while not self.finished.empty():
+            self.finished.get()
+
+    def __collect(self):
+        self.polling = None
+        error = None
+        while not self.finished.empty():
+            done, result, e = self.finished.get()
+            if e != None: error = e
+            else: done(result)
+
+        with self.condition:
+            busy = self.running or len(self.pending) > 0
+        if busy or not self.finished.empty():
+            self.polling = self.master.after(self.poll, self.__collect)
+        if error != None:
+            raise error
+
+class Prefetcher:
+    """
+    Decodes the planes the user is likely to look at next on a background
+    thread, so they are in the plane caches by the time they are asked for.
+
+    Along depth, the slices ahead of the current one in the direction of the last
+    depth change are read; along time, the time points ahead in the direction of
+    the last time change, at the depth slices the view shows. Planes are read
+    through the same view, for the visible channels only. Histograms are not read
+    ahead: they need whole planes at full resolution, which would push the planes
+    being shown out of the caches. A new schedule or a cancel() abandons the
+    previous one between two planes.
+    """
+
+    def __init__(self, ahead = 3):
+        self.ahead = ahead
+        self.condition = threading.Condition()
+        self.job = None
+        # bumped by every schedule and cancel, a running job stops once it changes
+        self.generation = 0
+        self.running = False
+        self.thread = threading.Thread(target = self.__work, daemon = True)
+        self.thread.start()
+
+    def slices(self, z, direction, depth) -> list:
+        """
+        Return the indices to read after 'z' along an axis of 'depth' indices,
+        nearest first: those ahead in 'direction' (+1 or -1), or on both sides while
+        it is unknown (0).
+        """
+        if direction == 0:
+            slices = [z + sign * k for k in range(1, self.ahead + 1) for sign in (1, -1)]
+        else: slices = [z + direction * k for k in range(1, self.ahead + 1)]
+        return [s for s in slices if 0 <= s < depth]
+
+    def schedule(self, renderer, view, channels, z, direction, t = 0, scene = 0):
+        """
+        Read ahead the depth slices next to 'z' at time point 't'.
+        """
+        slices = [(s, t) for s in self.slices(z, direction, renderer.document.depth)]
+        self.__schedule(renderer, view, channels, scene, slices)
+
+    def schedule_times(self, renderer, view, channels, depths, t, direction, scene = 0):
+        """
+        Read ahead the time points next to 't' at the given depth slices.
+        """
+        times = self.slices(t, direction, renderer.document.times)
+        self.__schedule(renderer, view, channels, scene, [(d, s) for s in times for d in depths])
+
+    def __schedule(self, renderer, view, channels, scene, planes):
+        with self.condition:
+            self.generation += 1
+            self.job = (renderer, view, channels, scene, planes)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.job = None
+
+    def wait(self):
+        """
+        Cancel the prefetch and block until the plane being read is done.
+        """
+        with self.condition:
+            self.generation += 1
+            self.job = None
+            while self.running:
+                self.condition.wait()
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.job == None:
+                    self.condition.wait()
+                (renderer, view, channels, scene, planes), generation = self.job, self.generation
+                self.job = None
+                self.running = True
+
+            for z, t, cid in [(z, t, cid) for z, t in planes for cid in channels]:
+                with self.condition:
+                    if self.generation != generation:
+                        break
+                try:
+                    renderer.read_plane(cid, z, view, t, scene)
+                except Exception:
+                    # a failed prefetch is retried, and reported, by the render itself
+                    break
+
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+class Player:
+    """
+    Plays the time points of a view state at a fixed frame rate.
+
+    Frames are rendered ahead of the clock on a thread of their own, into a ring
+    of at most 'ahead' frames, and shown from the Tk loop when their time comes.
+    A frame that is not ready in time is dropped, and rendering skips on to the
+    frames still in the future, so playback keeps to the clock rather than
+    falling behind it. The renderer must not be shared with other threads.
+    """
+
+    def __init__(self, master, renderer, state, fps, show, ahead = 8):
+        self.master = master
+        self.renderer = renderer
+        self.state = state
+        self.interval = 1 / fps
+        self.show = show
+        self.ahead = ahead
+        self.first = state.t
+        self.condition = threading.Condition()
+        # frame number -> (t, image), rendered and waiting for their time
+        self.frames = {}
+        self.playing = True
+        # frame 0 is the time point on screen, playback starts with frame 1
+        self.start = time.perf_counter()
+        self.next = 1
+        self.shown = 0
+        self.thread = threading.Thread(target = self.__produce, daemon = True)
+        self.thread.start()
+        self.job = self.master.after(int(self.interval * 1000), self.__tick)
+
+    def clock(self) -> int:
+        """
+        Return the number of the frame due now.
+        """
+        return int((time.perf_counter() - self.start) / self.interval)
+
+    def dropped(self) -> int:
+        return max(0, self.clock() - self.shown)
+
+    def update(self, state):
+        """
+        Play on with a new view state; frames rendered from the old one are dropped.
+        """
+        with self.condition:
+            self.state = state
+            self.frames = {}
+            self.next = self.clock() + 1
+
+    def stop(self):
+        with self.condition:
+            self.playing = False
+            self.condition.notify_all()
+        self.master.after_cancel(self.job)
+        self.thread.join()
+
+    def __produce(self):
+        times = self.renderer.document.times
+        while True:
+            with self.condition:
+                while self.playing and self.next > self.clock() + self.ahead:
+                    self.condition.wait(self.interval)
+                if not self.playing:
+                    return
+                # frames due already are never rendered
+                self.next = max(self.next, self.clock() + 1)
+                n, state = self.next, self.state
+                self.next += 1
+
+            t = (self.first + n) % times
+            image = Image.fromarray(self.renderer.frame(state._replace(t = t)))
+            with self.condition:
+                if state is self.state:
+                    self.frames[n] = (t, image)
+
+    def __tick(self):
+        now = self.clock()
+        with self.condition:
+            frame = self.frames.pop(now, None)
+            self.frames = {n: f for n, f in self.frames.items() if n > now}
+            self.condition.notify_all()
+        if frame != None:
+            self.shown += 1
+            self.show(*frame)
+
+        due = self.start + (now + 1) * self.interval
+        self.job = self.master.after(max(1, int((due - time.perf_counter()) * 1000)), self.__tick)
+
+class RenderScheduler:
+    """
+    Coalesces redraw requests coming from slider and mouse events.
+
+    A request only marks its task as pending; pending tasks run from the Tk event
+    loop at most once per 'interval' milliseconds (or per duration of the last run,
+    if that was longer). Tasks read the widgets when they run, so a burst of
+    events renders once, with the newest state, and stale requests are dropped.
+    """
+
+    def __init__(self, master, interval = 30):
+        self.master = master
+        self.interval = interval
+        # task -> None, as an insertion-ordered set
+        self.pending = {}
+        self.job = None
+        self.last_start = 0.0
+        self.last_duration = 0.0
+
+    def request(self, task):
+        self.pending[task] = None
+        if self.job != None:
+            return
+        elapsed = (time.perf_counter() - self.last_start) * 1000
+        wait = max(self.interval, self.last_duration) - elapsed
+        self.job = self.master.after(max(int(wait), 0), self.__run)
+
+    def cancel(self):
+        if self.job != None:
+            self.master.after_cancel(self.job)
+        self.job = None
+        self.pending = {}
+
+    def __run(self):
+        self.job = None
+        tasks, self.pending = list(self.pending), {}
+        self.last_start = time.perf_counter()
+        for task in tasks:
+            task()
+        self.last_duration = (time.perf_counter() - self.last_start) * 1000
+
 class App(Tk):
 
+    # (width, height) of the image canvas
+    PREVIEW_SIZE = (800, 800)
+
     def __init__(self):
 
+        if sys.platform == 'win32':
+            ctypes.windll.shcore.SetProcessDpiAwareness(1)
         Tk.__init__(self)
 
         # current open document
         self.opened_czi = None
         self.control_list = []
-        self.histograms = []
-
-        self.tk.call('tk', 'scaling', ScaleFactor / 75)
+        self.scheduler = RenderScheduler(self)
+        self.worker = RenderWorker(self)
+        # full-resolution histograms have a thread of their own, so one being
+        # counted never holds back a preview
+        self.histogram_worker = RenderWorker(self)
+        self.prefetcher = Prefetcher()
+        self.last_depth = None
+        self.depth_direction = 0
+        self.last_time = None
+        self.time_direction = 0
+        self.player = None
+        self.canvas_image = None
+        self.frame_requested = 0
+
+        # dpi awareness is a windows api; elsewhere tk keeps its own scaling
+        if sys.platform == 'win32':
+            self.tk.call('tk', 'scaling', ctypes.windll.shcore.GetScaleFactorForDevice(0) / 75)
         self.title("CZI (Carl Zeiss Image) Composer")
         self.config(bg = "white")
 
@@ -376,6 +699,13 @@ class App(Tk):
 
         self.canvas = Canvas(self.right_frame, height = 800, width = 800, bg = 'white')
         self.canvas.grid(row = 0, column = 0)
+        # drag to pan, wheel to zoom, double click to fit the image
+        self.canvas.bind("<ButtonPress-1>", self.start_pan)
+        self.canvas.bind("<B1-Motion>", self.pan_view)
+        self.canvas.bind("<Double-Button-1>", self.fit_view)
+        self.canvas.bind("<MouseWheel>", self.zoom_view)
+        self.canvas.bind("<Button-4>", self.zoom_view)
+        self.canvas.bind("<Button-5>", self.zoom_view)
 
         label = Label(self.left_frame, text="Channel mixer", width = 60, font = self.bold_font)
         label.grid(row = 1, column = 0)
@@ -450,28 +780,47 @@ class App(Tk):
         self.merge_mode.set('Maximum (Lighten)')
         self.merge_mode_combo = ttk.Combobox(self.depth_frame, 
                                              textvariable = self.merge_mode,
-                                             values = (
-                                                 'Maximum (Lighten)',
-                                                 'Minimum (Darken)',
-                                                 'Screen',
-                                                 'Color Burn',
-                                                 'Color Dodge',
-                                                 'Linear Burn',
-                                                 'Linear Dodge',
-                                                 'Overlay',
-                                                 'Hard Light',
-                                                 'Soft Light',
-                                                 'Vivid Light',
-                                                 'Linear Light',
-                                                 'Pin Light',
-                                                 'Hard Mix',
-                                                 'Difference',
-                                                 'Exclusion',
-                                                 'Substract',
-                                                 'Multiply',
-                                                 'Divide'))
+                                             values = tuple(BLEND_MODES))
         self.merge_mode_combo.grid(row = 2, column = 1, padx = 30, pady = [10, 20], sticky = 'w')
 
+        self.current_time = IntVar()
+        self.current_scene = IntVar()
+        self.play_fps = IntVar()
+        self.play_fps.set(10)
+
+        label7 = Label(self.depth_frame, text="Time point", justify = RIGHT)
+        label7.grid(row = 5, column = 0, sticky = E, pady = [20, 0])
+        label7.config(bg = 'white')
+        self.time_slider = Scale(self.depth_frame, from_=0, to=1, orient='horizontal', 
+                             command = self.update_t, 
+                             variable = self.current_time,
+                             state = DISABLED, length = 250, tickinterval = 2)
+        self.time_slider.grid(row = 5, column = 1, padx = [30, 0], pady = [20, 0])
+        self.time_slider.config(bg = 'white', highlightthickness = 0)
+
+        label8 = Label(self.depth_frame, text="Scene", justify = RIGHT)
+        label8.grid(row = 6, column = 0, sticky = E)
+        label8.config(bg = 'white')
+        self.scene_slider = Scale(self.depth_frame, from_=0, to=1, orient='horizontal', 
+                             command = self.update_scene, 
+                             variable = self.current_scene,
+                             state = DISABLED, length = 250, tickinterval = 1)
+        self.scene_slider.grid(row = 6, column = 1, padx = [30, 0])
+        self.scene_slider.config(bg = 'white', highlightthickness = 0)
+
+        self.play_frame = Frame(self.depth_frame)
+        self.play_frame.grid(row = 7, column = 1, padx = 30, pady = [10, 0], sticky = 'w')
+        self.play_frame.config(bg = 'white')
+        self.play_button = Button(self.play_frame, text = 'Play', width = 8,
+                                  command = self.toggle_playback, state = DISABLED)
+        self.play_button.grid(row = 0, column = 0)
+        self.play_rate = Spinbox(self.play_frame, from_ = 1, to = 60, width = 4,
+                                 textvariable = self.play_fps)
+        self.play_rate.grid(row = 0, column = 1, padx = [10, 0])
+        label9 = Label(self.play_frame, text = "frames per second")
+        label9.grid(row = 0, column = 2, padx = [5, 0])
+        label9.config(bg = 'white')
+
         self.menubar = Menu(self)
         self.config(menu = self.menubar)
         self.file_menu = Menu(self.menubar)
@@ -486,6 +835,22 @@ class App(Tk):
             menu = self.file_menu
         )
 
+        self.show_stats = BooleanVar()
+        self.view_menu = Menu(self.menubar)
+        self.view_menu.add_checkbutton(
+            label = 'Show render statistics',
+            variable = self.show_stats,
+            command = self.draw_stats
+        )
+        self.view_menu.add_command(
+            label = 'Export render log ...',
+            command = self.save_log
+        )
+        self.menubar.add_cascade(
+            label="View",
+            menu = self.view_menu
+        )
+
         self.style = ttk.Style(self)
         self.style.theme_use('vista')
 
@@ -517,23 +882,36 @@ Copyright (C) Z. Yang 2023""",
         first_open = (self.opened_czi == None)
 
         name = fd.askopenfilename()
-        self.opened_czi = CziFile(name)
+        if not name:
+            return
+
+        # the open file stays in use until the new one could be read
+        try:
+            with timings.stage('open'):
+                document = CziDocument(name, cache = CACHE_DIRECTORY)
+        except Exception as e:
+            messagebox.showerror('Open', 'Could not open %s:\n%s' % (name, e))
+            return
+
+        if not first_open:
+            self.stop_playback()
+            self.scheduler.cancel()
+            self.worker.wait()
+            self.histogram_worker.wait()
+            self.prefetcher.wait()
+            self.opened_czi.close()
+        self.last_depth = None
+        self.depth_direction = 0
+        self.last_time = None
+        self.time_direction = 0
+        self.opened_czi = document
+        self.renderer = Renderer(self.opened_czi)
+        self.current_time.set(0)
+        self.current_scene.set(0)
+        self.fit_view()
         self.channel_colors = []
-        meta = self.opened_czi.metadata()
-        self.np = czifile.imread(name)
-        b, h, t, c, z, y, x, o = self.np.shape
-        self.np = self.np[0,0,0,:,:,:,:,0] / 255.0 # c, z, y, x
-        
-        self.histograms = []
-        for zid in range(z):
-            zhist = []
-            for cid in range(c):
-                hist, _ = npy.histogram(self.np[cid, zid], 
-                                        bins = [i / 255 for i in range(256)], 
-                                        density = False)
-                zhist += [hist]
-            self.histograms += [zhist]
-        
+        c, z = self.opened_czi.channels, self.opened_czi.depth
+
         if z > 1:
             self.depth_slider.config(state = NORMAL, to = z - 1)
             self.merge_z_from.config(state = NORMAL, to = z - 1)
@@ -542,6 +920,12 @@ Copyright (C) Z. Yang 2023""",
             self.depth_slider.config(state = DISABLED, to = 1)
             self.merge_z_from.config(state = DISABLED, to = 1)
             self.merge_z_to.config(state = DISABLED, to = 1)
+
+        # time points and scenes are decoded when they are selected
+        times, scenes = self.opened_czi.times, self.opened_czi.scenes
+        self.time_slider.config(state = NORMAL if times > 1 else DISABLED, to = max(times - 1, 1))
+        self.play_button.config(state = NORMAL if times > 1 else DISABLED)
+        self.scene_slider.config(state = NORMAL if scenes > 1 else DISABLED, to = max(scenes - 1, 1))
         
         for ctrlg in self.control_list:
             lbl, slider, canvas, check, _, txt = ctrlg
@@ -553,52 +937,15 @@ Copyright (C) Z. Yang 2023""",
         
         self.control_list = []
         self.channel_colors = []
+        self.channel_gamma = []
 
         # initialize the channel selector
-        for cid in range(c):
-            DOMTree = xml.dom.minidom.parseString(meta)
-            imgDocument = DOMTree.documentElement
-            metadata = imgDocument.getElementsByTagName("Metadata")
-            displaySetting = imgDocument.getElementsByTagName("DisplaySetting")
-            channels = displaySetting[0].getElementsByTagName("Channels")
-            channelArr = channels[0].getElementsByTagName("Channel")
-            
-            def hex2rgb(hexcolor):
-                hexcolor = int(hexcolor, base=16) if isinstance(hexcolor, str) else hexcolor
-                _rgb = ((hexcolor >> 16) & 0xff, (hexcolor >> 8) & 0xff, hexcolor & 0xff)
-                return _rgb
-            
-            channelProp = channelArr[cid]
-            if len(channelProp.getElementsByTagName("Color")) == 0:
-                continue
-            
-            colorString = channelProp.getElementsByTagName("Color")[0].childNodes[0].data
-            colorString = colorString[3:9]
-            cr, cg, cb = hex2rgb(colorString)
-            
-            # init the default values
-            low = 0 
-            high = 1
-            visible = True
-            # FIXME: do not implement gamma function
-            
-            cr, cg, cb = (0, 0, 0)
-            colorString = 'FFFFFF'
-            shortname = 'Channel '+str(cid)
-            if len(channelProp.getElementsByTagName("Color")) == 1:
-                colorString = channelProp.getElementsByTagName("Color")[0].childNodes[0].data
-                colorString = colorString[3:9]
-                cr, cg, cb = hex2rgb(colorString)
-            if len(channelProp.getElementsByTagName("Low")) == 1:
-                low = float(channelProp.getElementsByTagName("Low")[0].childNodes[0].data)
-            if len(channelProp.getElementsByTagName("ShortName")) == 1:
-                shortname = channelProp.getElementsByTagName("ShortName")[0].childNodes[0].data
-            if len(channelProp.getElementsByTagName("High")) == 1:
-                high = float(channelProp.getElementsByTagName("High")[0].childNodes[0].data)
-            if len(channelProp.getElementsByTagName("IsSelected")) == 1:
-                visible = not (channelProp.getElementsByTagName("IsSelected")[0].childNodes[0].data == "false")
-            
+        for cid, setting in enumerate(self.opened_czi.channel_settings()):
+            shortname, (cr, cg, cb), low, high, gamma, visible = setting
+            colorString = '%02X%02X%02X' % (cr, cg, cb)
+
             self.channel_colors += [(cr, cg, cb, colorString)]
+            self.channel_gamma += [gamma]
 
             label_channel_name = Label(self.channel_frame, text = shortname)
             label_channel_name.grid(row = cid, column = 0)
@@ -607,6 +954,7 @@ Copyright (C) Z. Yang 2023""",
             txt_channel = Text(self.channel_frame, width = 10, height = 1)
             txt_channel.grid(row = cid, column = 1)
             txt_channel.config(bg = 'white')
+            txt_channel.bind('<KeyRelease>', self.draw_labels)
             
             slider = RangeSlider(self.channel_frame, 0, 1, value_in = low, value_out = high, width = 200,
                                  command = self.update_image)
@@ -646,222 +994,315 @@ Copyright (C) Z. Yang 2023""",
         pass
 
     def save_file(self):
-        self.update_image()
         fn = fd.asksaveasfilename(initialfile = 'export.png',
                                   defaultextension = '.png',
                                   filetypes = [('PNG file', '*.png'),
                                                ('JPEG file', '*.jpg'),
-                                               ('Tagged image file format', '*.tiff')])
-        self.image.save(fn)
+                                               ('Tagged image file format', '*.tiff'),
+                                               ('OME-TIFF stack of all planes', '*.ome.tif')])
+        if not fn:
+            return
+        if fn.lower().endswith(('.ome.tif', '.ome.tiff')):
+            StackWriter(self.opened_czi).write(fn)
+            return
 
-        for cid in range(len(self.channeldata)):
-            imc = Image.fromarray(npy.uint8( self.channeldata[cid] * 255 ))
-            imc.save(fn.replace('.png', '.' + str(cid) + '.tiff'))
+        image = self.export_image()
+        save_export(fn, image, list(zip(self.visible_channels, self.channeldata)))
         pass
     
+    def view_state(self, view = None):
+        """
+        Snapshot the widgets into a ViewState, for the given view or full resolution.
+        """
+        channels = []
+        for cid in range(len(self.control_list)):
+            _, slider, _, _, is_layer_visible, _ = self.control_list[cid]
+            low, high = slider.get_in_and_out()
+            cr, cg, cb, _ = self.channel_colors[cid]
+            channels += [ChannelState(cid, low, high, (cr, cg, cb),
+                                      self.channel_gamma[cid], is_layer_visible.get())]
+        return ViewState(view, self.show_merge_variable.get(), self.current_depth.get() - 1,
+                         self.zstart.get(), self.zend.get(), self.merge_mode.get(), tuple(channels),
+                         self.current_time.get(), self.current_scene.get())
+
+    def export_image(self):
+        """
+        Render the full-resolution image with channel labels for saving. The
+        visible channel planes are kept in 'channeldata'.
+        """
+        # a renderer of its own, so its buffers are not shared with the worker thread
+        rgb, planes = Renderer(self.opened_czi).render(self.view_state())
+        self.image = Image.fromarray(rgb)
+        self.channeldata = [plane for _, plane in planes]
+        self.visible_channels = [cid for cid, _ in planes]
+
+        with timings.stage('labels'):
+            Labels.burn(self.image, self.labels(self.visible_channels), self.show_merge_variable.get())
+
+        return self.image
+
     def update_merged(self, event = None):
         if not self.show_merge_variable.get():
             return
-        
-        startz = self.zstart.get()
-        endz = self.zend.get()
-        if startz < endz: zrange = range(startz, endz + 1, 1)
-        if startz > endz: zrange = range(startz, endz - 1, -1)
-        if startz == endz: zrange = [startz]
-
-        c, _, y, x = self.np.shape
-        rgb = npy.zeros((y, x, 3))
-        
-        mergenp = self.np[:, zrange[0], :, :] # c, y, x
-
-        for zid in range(len(zrange) - 1):
-            z = zrange[zid + 1]
-
-            mode = self.merge_mode.get()
-            modes = ('Maximum (Lighten)',
-                     'Minimum (Darken)',
-                     'Screen',
-                     'Color Burn',
-                     'Color Dodge',
-                     'Linear Burn',
-                     'Linear Dodge',
-                     'Overlay',
-                     'Hard Light',
-                     'Soft Light',
-                     'Vivid Light',
-                     'Linear Light',
-                     'Pin Light',
-                     'Hard Mix',
-                     'Difference',
-                     'Exclusion',
-                     'Substract',
-                     'Multiply',
-                     'Divide')
-            
-            this_layer = self.np[:, z, :, :]
-            if mode == 'Maximum (Lighten)':
-                mergenp = npy.maximum(mergenp, this_layer)
-            elif mode == 'Minimum (Darken)':
-                mergenp = npy.minimum(mergenp, this_layer)
-            elif mode == 'Multiply':
-                mergenp = mergenp * this_layer
-            elif mode == 'Screen':
-                mergenp = 1 - (1 - mergenp) * (1 - this_layer)
-            elif mode == 'Color Burn':
-                mergenp = 1 - (1 - mergenp) / (this_layer + 1e-5)
-            elif mode == 'Color Dodge':
-                mergenp = mergenp / (1 - this_layer + 1e-5)
-            elif mode == 'Linear Burn':
-                mergenp = this_layer + mergenp - 1
-            elif mode == 'Linear Dodge':
-                mergenp = this_layer + mergenp
-            elif mode == 'Overlay':
-                lt_mask = mergenp <= 0.5
-                gt_mask = mergenp > 0.5
-                mergenp[lt_mask] = (2 * this_layer * mergenp)[lt_mask]
-                mergenp[gt_mask] = (1 - 2 * (1-this_layer) * (1-mergenp))[gt_mask]
-            elif mode == 'Hard Light':
-                lt_mask = this_layer <= 0.5
-                gt_mask = this_layer > 0.5
-                mergenp[lt_mask] = (2 * this_layer * mergenp)[lt_mask]
-                mergenp[gt_mask] = (1 - 2 * (1-this_layer) * (1-mergenp))[gt_mask]
-            elif mode == 'Soft Light':
-                lt_mask = this_layer <= 0.5
-                gt_mask = this_layer > 0.5
-                mergenp[lt_mask] = (2 * this_layer * mergenp + mergenp * mergenp * (1 - 2 * this_layer))[lt_mask]
-                mergenp[gt_mask] = (2 * mergenp * (1 - this_layer) + npy.sqrt(mergenp) * (2 * this_layer - 1))[gt_mask]
-            elif mode == 'Vivid Light':
-                lt_mask = this_layer <= 0.5
-                gt_mask = this_layer > 0.5
-                mergenp[lt_mask] = (1 + (mergenp - 1) / (2 * this_layer + 1e-5))[lt_mask]
-                mergenp[gt_mask] = (mergenp / (2 * (1 - this_layer) + 1e-5))[gt_mask]
-            elif mode == 'Linear Light':
-                mergenp = 2 * this_layer + mergenp - 1
-            elif mode == 'Pin Light':
-                lt_mask = this_layer <= 0.5
-                gt_mask = this_layer > 0.5
-                mergenp[lt_mask] = (npy.minimum(2 * this_layer, mergenp))[lt_mask]
-                mergenp[gt_mask] = (npy.maximum(2 * (this_layer - 0.5), mergenp))[gt_mask]
-            elif mode == 'Hard Mix':
-                gt_mask = this_layer + mergenp >= 1
-                lt_mask = this_layer + mergenp < 1
-                mergenp[lt_mask] = 0
-                mergenp[gt_mask] = 1
-            elif mode == 'Difference':
-                mergenp = npy.abs(mergenp - this_layer)
-            elif mode == 'Exclusion':
-                mergenp = this_layer + mergenp - 2 * this_layer * mergenp
-            elif mode == 'Substract':
-                mergenp = mergenp - this_layer
-            elif mode == 'Divide':
-                mergenp = mergenp / (this_layer + 1e-5)
-            
-            mergenp[mergenp > 1] = 1
-            mergenp[mergenp < 0] = 0
+        self.update_image()
 
-        self.channeldata = []
-        for cid in range(c):
-            
-            _, slider, _, _, is_layer_visible, _ = self.control_list[cid]
-            low, high = slider.get_in_and_out()
-            visible = is_layer_visible.get()
-
-            linear = mergenp[cid,:,:] * 1
-            if high > low:
-                tk = 1 / (high - low)
-                tb = - low * tk
-                linear = tk * mergenp[cid,:,:] + tb
-                linear[linear < 0] = 0
-                linear[linear > 1] = 1
-            else:
-                linear[linear > high] = 1
-                linear[linear <= high] = 0
+    def view(self):
+        """
+        Return the canvas view: the full-resolution point at its top-left, the
+        full-resolution pixels per canvas pixel, and the canvas size.
+        """
+        return self.view_origin, self.view_scale, App.PREVIEW_SIZE
+
+    def fit_view(self, event = None):
+        height, width = self.opened_czi.plane_shape(self.current_scene.get())
+        cw, ch = App.PREVIEW_SIZE
+        self.view_scale = max(width / cw, height / ch)
+        self.view_origin = ((width - cw * self.view_scale) / 2, (height - ch * self.view_scale) / 2)
+        if event != None:
+            self.update_image()
+
+    def zoom_view(self, event):
+        if self.opened_czi == None:
+            return
+        if event.num == 5 or event.delta < 0: factor = 1 / 1.25
+        else: factor = 1.25
+
+        # keep the point under the cursor in place, from 8 canvas pixels per
+        # image pixel to twice the fitting scale
+        height, width = self.opened_czi.plane_shape(self.current_scene.get())
+        cw, ch = App.PREVIEW_SIZE
+        scale = self.view_scale / factor
+        scale = min(max(scale, 1 / 8), 2 * max(width / cw, height / ch))
+        x, y = self.view_origin
+        self.view_origin = (x + event.x * (self.view_scale - scale), y + event.y * (self.view_scale - scale))
+        self.view_scale = scale
+        # slices read ahead through the old view are of no use any more
+        self.prefetcher.cancel()
+        self.update_image()
 
-            cr, cg, cb, _ = self.channel_colors[cid]
+    def start_pan(self, event):
+        if self.opened_czi == None:
+            return
+        self.pan_start = (event.x, event.y, self.view_origin)
 
-            if visible:
-                rgb[:,:,0] += (cr / 255) * linear
-                rgb[:,:,1] += (cg / 255) * linear
-                rgb[:,:,2] += (cb / 255) * linear
-                self.channeldata += [mergenp[cid,:,:]]
-        
-        rgb[rgb > 1] = 1
-        rgb[rgb < 0] = 0
-        self.image = Image.fromarray(npy.uint8(rgb * 255))
-        resized_image = self.image.resize((800, 800))
-
-        d = ImageDraw.Draw(self.image)
-        fnt = ImageFont.truetype('arialbd.ttf', 64)
-        col = 0
-        for cid in range(c):
-            _, slider, _, _, is_layer_visible, txt = self.control_list[cid]
-            if is_layer_visible.get():
-                d.text((50, 50 + 80 * col), txt.get('1.0','1.end'), '#' + self.channel_colors[cid][3], fnt)
-                col += 1
-            else: continue
-
-        self.tkimage = ImageTk.PhotoImage(resized_image)
-        self.canvas.create_image(0, 0, anchor = NW, image = self.tkimage)
-        pass
+    def pan_view(self, event):
+        if self.opened_czi == None:
+            return
+        ex, ey, (x, y) = self.pan_start
+        self.view_origin = (x - (event.x - ex) * self.view_scale, y - (event.y - ey) * self.view_scale)
+        self.prefetcher.cancel()
+        self.update_image()
 
     def update_image(self):
-        if self.show_merge_variable.get():
-            self.update_merged()
+        self.scheduler.request(self.redraw)
+
+    def redraw(self):
+        # levels and colors are applied to the visible tiles at display resolution,
+        # full resolution is only composed by export_image when saving
+        state = self.view_state(self.view())
+        if self.player != None:
+            self.player.update(state)
+            return
+        renderer = self.renderer
+        requested = time.perf_counter()
+
+        def show(image):
+            # a frame still rendering must not replace a newer one taken from the cache
+            if requested < self.frame_requested:
+                return
+            self.frame_requested = requested
+            self.show_frame(image)
+            # from the request to the frame on screen, scheduling included
+            timings.record('frame', time.perf_counter() - requested)
+
+        # views shown before are taken from the frame cache, without the worker
+        rgb = renderer.cached_frame(state)
+        if rgb is not None:
+            self.worker.cancel('image')
+            with timings.stage('fromarray'):
+                image = Image.fromarray(rgb)
+            show(image)
             return
-        
-        z = self.current_depth.get() - 1
-        c, _, y, x = self.np.shape
-        rgb = npy.zeros((y, x, 3))
 
-        self.channeldata = []
-        for cid in range(c):
-            
-            _, slider, _, _, is_layer_visible, txt = self.control_list[cid]
-            low, high = slider.get_in_and_out()
-            visible = is_layer_visible.get()
-
-            linear = self.np[cid,z,:,:] * 1
-            if high > low:
-                tk = 1 / (high - low)
-                tb = - low * tk
-                linear = tk * self.np[cid,z,:,:] + tb
-                linear[linear < 0] = 0
-                linear[linear > 1] = 1
+        def render():
+            with timings.stage('render'):
+                rgb = renderer.render_frame(state)
+            with timings.stage('fromarray'):
+                return Image.fromarray(rgb)
+
+        self.worker.submit('image', render, show)
+
+    def show_frame(self, image):
+        # the canvas keeps showing the previous frame until this one is complete
+        with timings.stage('photoimage'):
+            self.tkimage = ImageTk.PhotoImage(image)
+            if self.canvas_image == None:
+                self.canvas_image = self.canvas.create_image(0, 0, anchor = NW, image = self.tkimage)
             else:
-                linear[linear > high] = 1
-                linear[linear <= high] = 0
+                self.canvas.itemconfig(self.canvas_image, image = self.tkimage)
+        self.draw_labels()
+        self.draw_stats()
 
-            cr, cg, cb, _ = self.channel_colors[cid]
+    def labels(self, channels) -> list:
+        """
+        Return the (text, '#rrggbb') labels of the given channels.
+        """
+        labels = []
+        for cid in channels:
+            _, _, _, _, _, txt = self.control_list[cid]
+            labels += [(txt.get('1.0', '1.end'), '#' + self.channel_colors[cid][3])]
+        return labels
 
-            if visible:
-                rgb[:,:,0] += (cr / 255) * linear
-                rgb[:,:,1] += (cg / 255) * linear
-                rgb[:,:,2] += (cb / 255) * linear
-                self.channeldata += [self.np[cid,z,:,:]]
-            
-        self.image = Image.fromarray(npy.uint8(rgb * 255))
-        resized_image = self.image.resize((800, 800))
-
-        d = ImageDraw.Draw(self.image)
-        fnt = ImageFont.truetype('harding.otf', 64)
-        col = 0
-        for cid in range(c):
-            _, slider, _, _, is_layer_visible, txt = self.control_list[cid]
-            if is_layer_visible.get():
-                d.text((50, 50 + 80 * col), txt.get('1.0','1.end'), '#' + self.channel_colors[cid][3], fnt)
-                col += 1
-            else: continue
-
-        self.tkimage = ImageTk.PhotoImage(resized_image)
-        self.canvas.create_image(0, 0, anchor = NW, image = self.tkimage)
+    def draw_labels(self, event = None):
+        """
+        Draw the labels of the visible channels as canvas items, where and as large
+        as they will be burned into the export.
+        """
+        self.canvas.delete('labels')
+        if self.opened_czi == None:
+            return
+        visible = [cid for cid in range(len(self.control_list)) if self.control_list[cid][4].get()]
+        (vx, vy), scale, _ = self.view()
+        size = max(1, round(Labels.SIZE / scale))
+        family = ('Arial', -size, 'bold') if self.show_merge_variable.get() else ('Arial', -size)
+        x, y = Labels.ORIGIN
+        for line, (text, color) in enumerate(self.labels(visible)):
+            self.canvas.create_text((x - vx) / scale, (y + line * Labels.SPACING - vy) / scale,
+                                    anchor = NW, text = text, fill = color, font = family,
+                                    tags = 'labels')
+        self.canvas.tag_raise('stats')
+
+    def draw_stats(self):
+        """
+        Draw the stage timings and cache counters over the image, if enabled.
+        """
+        self.canvas.delete('stats')
+        if not self.show_stats.get():
+            return
 
-        pass
+        lines = ['%-10s %5s %7s %7s %7s' % ('stage', 'n', 'last', 'mean', 'max')]
+        for name, (count, last, mean, maximum) in sorted(timings.summary().items()):
+            lines += ['%-10s %5d %7.1f %7.1f %7.1f' % (name, count, last * 1000, mean * 1000, maximum * 1000)]
+        lines += ['', '%-10s %7s %7s %7s %9s' % ('cache', 'hits', 'misses', 'evicted', 'MB')]
+        if self.opened_czi != None:
+            for name, stats in self.renderer.stats().items():
+                lines += ['%-10s %7d %7d %7d %9.1f' % (name, stats.hits, stats.misses, stats.evictions,
+                                                      stats.size / 2 ** 20)]
+        if self.player != None:
+            lines += ['', '%-10s %7d shown %7d dropped' % ('playback', self.player.shown,
+                                                            self.player.dropped())]
+
+        text = self.canvas.create_text(10, 10, anchor = NW, text = '\n'.join(lines), fill = 'yellow',
+                                       font = ('Courier', 9), tags = 'stats')
+        x0, y0, x1, y1 = self.canvas.bbox(text)
+        background = self.canvas.create_rectangle(x0 - 4, y0 - 4, x1 + 4, y1 + 4, fill = 'black',
+                                                  outline = '', tags = 'stats')
+        self.canvas.tag_lower(background, text)
+
+    def save_log(self):
+        fn = fd.asksaveasfilename(initialfile = 'render-log.jsonl',
+                                  defaultextension = '.jsonl',
+                                  filetypes = [('JSON lines', '*.jsonl')])
+        if fn == '':
+            return
+        timings.write_log(fn, self.renderer.stats() if self.opened_czi != None else {})
         
     def update_z(self, event):
         if self.show_merge_variable.get():
             return
         
-        z = self.current_depth.get() - 1
+        self.update_image()
+        self.scheduler.request(self.draw_histogram)
+        self.prefetch()
+
+    def prefetch(self):
+        """
+        Read ahead the depth slices next to the current one, in the direction the
+        depth slider last moved.
+        """
+        if self.opened_czi == None:
+            return
+        z = (self.current_depth.get() - 1) % self.opened_czi.depth
+        if self.last_depth != None and z != self.last_depth:
+            self.depth_direction = 1 if z > self.last_depth else -1
+        self.last_depth = z
+        self.prefetcher.schedule(self.renderer, self.view(), self.shown_channels(), z,
+                                 self.depth_direction, self.current_time.get(), self.current_scene.get())
+
+    def update_t(self, event):
+        # the slider follows the frames while playing
+        if self.player != None:
+            return
+        self.update_image()
+        self.scheduler.request(self.draw_histogram)
+        self.prefetch_times()
+
+    def prefetch_times(self):
+        """
+        Read ahead the time points next to the current one, in the direction the
+        time slider last moved, at the depth slices the image shows.
+        """
+        if self.opened_czi == None:
+            return
+        t = self.current_time.get()
+        if self.last_time != None and t != self.last_time:
+            self.time_direction = 1 if t > self.last_time else -1
+        self.last_time = t
+
+        z = (self.current_depth.get() - 1) % self.opened_czi.depth
+        depths = [z]
+        if self.show_merge_variable.get():
+            zstart, zend = self.zstart.get(), self.zend.get()
+            depths = list(range(min(zstart, zend), max(zstart, zend) + 1))
+        self.prefetcher.schedule_times(self.renderer, self.view(), self.shown_channels(), depths, t,
+                                       self.time_direction, self.current_scene.get())
+
+    def shown_channels(self) -> list:
+        """
+        Return the ids of the channels ticked visible.
+        """
+        return [cid for cid, (_, _, _, _, visible, _) in enumerate(self.control_list) if visible.get()]
+
+    def update_scene(self, event):
+        self.stop_playback()
+        self.prefetcher.cancel()
+        self.fit_view()
+        self.update_image()
+        self.scheduler.request(self.draw_histogram)
+
+    def toggle_playback(self):
+        if self.player != None:
+            self.stop_playback()
+            return
+        # the player renders with a renderer of its own, apart from the worker thread
+        self.player = Player(self, Renderer(self.opened_czi), self.view_state(self.view()),
+                             max(1, self.play_fps.get()), self.show_playback)
+        self.play_button.config(text = 'Stop')
+
+    def stop_playback(self):
+        if self.player == None:
+            return
+        self.player.stop()
+        self.player = None
+        self.play_button.config(text = 'Play')
+        self.update_image()
+        self.scheduler.request(self.draw_histogram)
+
+    def show_playback(self, t, image):
+        self.current_time.set(t)
+        self.show_frame(image)
+
+    def draw_histogram(self):
+        z = (self.current_depth.get() - 1) % self.opened_czi.depth
+        t, scene = self.current_time.get(), self.current_scene.get()
+        histograms = self.renderer.histograms
+        if histograms.has(z, t, scene):
+            self.show_histogram(histograms.slice(z, t, scene))
+        else:
+            self.histogram_worker.submit('histogram', lambda: histograms.slice(z, t, scene),
+                                         self.show_histogram)
+
+    def show_histogram(self, zhist):
         disp_w = self.canvas_histogram.winfo_reqwidth()
         disp_h = self.canvas_histogram.winfo_reqheight()
         item_w = disp_w / 256.0
@@ -869,19 +1310,16 @@ Copyright (C) Z. Yang 2023""",
         self.canvas_histogram.delete('all')
 
         channel = 0
-        for chist in self.histograms[z]:
-            points = [(0, disp_h)]
-            i = 0
-            for freq in chist:
-                points += [(i * item_w, disp_h - disp_h * (npy.log10(freq + 1) / 6) )]
-                i += 1
-            
-            points += [(disp_w, disp_h)]
+        for chist in zhist:
+            # bottom-left corner, one point per bin, bottom-right corner
+            points = npy.empty((len(chist) + 2, 2))
+            points[0] = (0, disp_h)
+            points[1:-1, 0] = npy.arange(len(chist)) * item_w
+            points[1:-1, 1] = disp_h - disp_h * (npy.log10(chist + 1) / 6)
+            points[-1] = (disp_w, disp_h)
             cr, cg, cb, ccolor = self.channel_colors[channel]
-            hist_poly = self.canvas_histogram.create_polygon(*points, fill = '#' + ccolor)
+            hist_poly = self.canvas_histogram.create_polygon(*points.ravel().tolist(), fill = '#' + ccolor)
             channel += 1
-        
-        self.update_image()
         pass
 
     def canvas_colorpick(self, event):
@@ -900,4 +1338,7 @@ Copyright (C) Z. Yang 2023""",
         self.update_image()
         pass
 
-app = App()
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(batch())
+    app = App()
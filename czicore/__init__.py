@@ -0,0 +1,17 @@
+"""
+The core of the CZI composer, without a gui.
+
+Documents, renderers, z-projections, histograms and exporters for CZI files,
+usable from scripts, notebooks and batch workers. tkinter is never imported,
+and czifile and tifffile are only imported once a file is opened or written.
+
+    from czicore import CziDocument, Renderer, ViewState
+"""
+
+from .document import (CACHE_DIRECTORY, CacheStats, ChannelSetting, CziDocument, CziMetadata,
+                       DiskCache, PlaneCache, TilePyramid, file_identity)
+from .export import (Labels, StackWriter, batch, batch_export, batch_settings, read_preset,
+                     save_export)
+from .render import (BLEND_MODES, Blender, BlendMode, ChannelState, Compositor, Histograms,
+                     Renderer, ViewState, ZProjector)
+from .timing import Timings, timings
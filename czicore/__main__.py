@@ -0,0 +1,6 @@
+import sys
+
+from .export import batch
+
+if __name__ == '__main__':
+    sys.exit(batch())
@@ -0,0 +1,586 @@
+"""
+Lazy access to CZI files: their metadata, the decoded planes of their
+subblocks, and the caches kept of them in memory and on disk.
+"""
+
+import hashlib
+import os
+import threading
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import numpy as npy
+
+from .timing import timings
+
+# display settings of a channel as saved by ZEN; 'color' is an (r, g, b) triple,
+# 'low' and 'high' are fractions of the white level
+ChannelSetting = namedtuple('ChannelSetting', ['name', 'color', 'low', 'high', 'gamma', 'visible'])
+
+# counters of a PlaneCache; 'size' and 'budget' are in bytes
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evictions', 'entries', 'size', 'budget'])
+
+# decoded planes are cached on disk under this directory when it is set
+CACHE_DIRECTORY = os.environ.get('CZI_CACHE')
+
+def file_identity(path) -> tuple:
+    """
+    Return a key that changes whenever the file at 'path' does: its real path,
+    size and modification time.
+    """
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+class DiskCache:
+    """
+    Decoded planes and histograms of a CZI file, kept on disk across sessions.
+
+    Each version of a file gets a directory of its own under 'root', named after
+    a hash of its identity, holding one .npy file per full-resolution plane and
+    per histogram. Planes are memory-mapped when read back, so a view only pages
+    in the rows it samples; each map holds a file descriptor, so only the MAPS
+    most recently used are kept open. Entries are written atomically and never
+    updated; the root can be deleted at any time to reclaim the space.
+    """
+
+    MAPS = 64
+
+    def __init__(self, root, path):
+        digest = hashlib.sha1(repr(file_identity(path)).encode()).hexdigest()
+        self.directory = os.path.join(root, digest)
+        os.makedirs(self.directory, exist_ok = True)
+        # key -> memory-mapped plane, least recently used first
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filename(self, kind, key) -> str:
+        return os.path.join(self.directory, kind + '.' + '.'.join(str(k) for k in key) + '.npy')
+
+    def load(self, kind, key, mmap_mode = None):
+        """
+        Return the cached array of a kind ('plane' or 'histogram') and key, or None.
+        """
+        fn = self.filename(kind, key)
+        if not os.path.exists(fn):
+            return None
+        return npy.load(fn, mmap_mode = mmap_mode)
+
+    def store(self, kind, key, array):
+        fn = self.filename(kind, key)
+        if os.path.exists(fn):
+            return
+        # other threads and batch processes may write the same entry
+        temporary = fn + '.%d.%d.tmp' % (os.getpid(), threading.get_ident())
+        with open(temporary, 'wb') as f:
+            npy.save(f, array)
+        os.replace(temporary, fn)
+
+    def plane(self, key):
+        """
+        Return the memory-mapped full-resolution plane of a (c, z, t, scene) key, or None.
+        """
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                return self.maps[key]
+        plane = self.load('plane', key, mmap_mode = 'r')
+        if plane is None:
+            return None
+        with self.lock:
+            self.maps[key] = plane
+            # an evicted map is closed once its last reader lets go of it
+            while len(self.maps) > DiskCache.MAPS:
+                self.maps.popitem(last = False)
+        return plane
+
+    def close(self):
+        with self.lock:
+            self.maps = OrderedDict()
+
+class PlaneCache:
+    """
+    Decoded planes (or tiles of them) kept in memory up to a byte budget, the
+    least recently used evicted first.
+
+    Keys start with (scene, time, channel, depth, level), level 0 being full
+    resolution. Cached arrays are shared between callers, so they are made
+    read-only. Counts of hits, misses and evictions are kept for stats().
+    """
+
+    BUDGET = 512 << 20
+
+    def __init__(self, budget = BUDGET):
+        self.budget = budget
+        # key -> array, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        # planes are read from the render thread and the Tk thread
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the array cached under 'key', or None.
+        """
+        with self.lock:
+            array = self.entries.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return array
+
+    def put(self, key, array):
+        """
+        Cache 'array' under 'key' and return it, read-only. Arrays above the
+        budget are returned without being kept.
+        """
+        array.setflags(write = False)
+        if array.nbytes > self.budget:
+            return array
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key).nbytes
+            self.entries[key] = array
+            self.size += array.nbytes
+            while self.size > self.budget:
+                _, evicted = self.entries.popitem(last = False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+        return array
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def __contains__(self, key):
+        # a peek, not counted as a hit or a miss
+        with self.lock:
+            return key in self.entries
+
+    def stats(self):
+        with self.lock:
+            return CacheStats(self.hits, self.misses, self.evictions,
+                              len(self.entries), self.size, self.budget)
+
+class CziMetadata:
+    """
+    The parts of the XML metadata of a CZI file the composer uses: the significant
+    bit count of the pixels and the display settings of the channels.
+
+    The XML is read with a streaming parser that stops after DisplaySetting and
+    drops the elements it does not need on the way, so the large experiment
+    description is never held as a tree. Results of the ENTRIES most recently
+    opened files are cached, keyed by path, size and modification time.
+    """
+
+    FEED_SIZE = 1 << 16
+    ENTRIES = 16
+    # file identity -> metadata, least recently used first
+    cache = OrderedDict()
+    lock = threading.Lock()
+
+    def __init__(self, xml):
+        self.bits = None
+        self.channels = []
+
+        parser = ElementTree.XMLPullParser(events = ('start', 'end'))
+        stack = []
+        for i in range(0, len(xml), CziMetadata.FEED_SIZE):
+            parser.feed(xml[i:i + CziMetadata.FEED_SIZE])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    stack += [element.tag]
+                    continue
+                stack.pop()
+
+                if element.tag == 'ComponentBitCount' and 'Image' in stack:
+                    # an empty or malformed count leaves the bits to the pixel type
+                    count = (element.text or '').strip()
+                    self.bits = int(count) if count.isdigit() and int(count) > 0 else None
+                elif element.tag == 'Channel' and stack[-2:] == ['DisplaySetting', 'Channels']:
+                    self.channels += [CziMetadata.channel_setting(element, len(self.channels))]
+                elif element.tag == 'DisplaySetting':
+                    return
+
+                if 'DisplaySetting' not in stack:
+                    element.clear()
+
+    @staticmethod
+    def channel_setting(element, cid):
+        def text(tag, default):
+            child = element.find(tag)
+            return child.text if child != None and child.text != None else default
+
+        # colors are saved as #AARRGGBB
+        color = int(text('Color', '#FFFFFFFF').lstrip('#')[-6:], base = 16)
+        return ChannelSetting(text('ShortName', 'Channel ' + str(cid)),
+                              ((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff),
+                              float(text('Low', 0)),
+                              float(text('High', 1)),
+                              float(text('Gamma', 1.0)),
+                              text('IsSelected', 'true') != 'false')
+
+    @staticmethod
+    def read(czi, path):
+        """
+        Return the metadata of an open CziFile, parsed once per version of the file.
+        """
+        key = file_identity(path)
+        with CziMetadata.lock:
+            if key in CziMetadata.cache:
+                CziMetadata.cache.move_to_end(key)
+                return CziMetadata.cache[key]
+        with timings.stage('metadata'):
+            metadata = CziMetadata(czi.metadata() or '')
+        with CziMetadata.lock:
+            CziMetadata.cache[key] = metadata
+            while len(CziMetadata.cache) > CziMetadata.ENTRIES:
+                CziMetadata.cache.popitem(last = False)
+        return metadata
+
+class CziDocument:
+    """
+    Lazy view of a CZI file, built on the subblock directory of CziFile.
+
+    Opening a document only reads the directory: subblocks are indexed by
+    (channel, depth, time, scene) and by their downsampling factor, 1 for full
+    resolution and more for the pyramid subblocks of virtual slides. Pixel data
+    is decoded when a plane or region is requested with read_plane or
+    read_region. Planes keep the native type of the file, and 'maximum' is the
+    white level of its bit depth. Float pixels have no bit depth, so for them
+    white is 255, as when the composer read the whole file with imread / 255.
+    Integer pixels of more than 16 significant bits are not supported.
+
+    Whole full-resolution planes are kept in a PlaneCache of 'budget' bytes.
+    With a 'cache' directory, they are also kept in a DiskCache once decoded,
+    and read back from there by this and later openings.
+
+    Subblocks of a region are decompressed on a pool of 'workers' threads
+    (one per core by default); the codecs release the GIL while they run.
+    Callers that need several whole planes at once, such as the channels of a
+    layer or the next strip of a stack, read them on the 'readers' pool of as
+    many threads. The reads wait on the decoding pool, so they are kept apart
+    from it and a full pool never waits on itself.
+    """
+
+    def __init__(self, path, cache = None, budget = PlaneCache.BUDGET, workers = None):
+        self.path = path
+        self.cache = DiskCache(cache, path) if cache != None else None
+        self.plane_cache = PlaneCache(budget)
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+        self.readers = ThreadPoolExecutor(workers or os.cpu_count())
+        # czifile brings in tifffile and its codecs, so it is only imported with a document
+        from czifile import CziFile
+        self.czi = CziFile(path)
+        # subblocks are read from several threads, serialize seek and read
+        self.czi._fh.lock = True
+        # uncompressed subblocks are read through a map of the whole file,
+        # which costs address space only; file position -> data offset
+        self.map = npy.memmap(path, npy.uint8, mode = 'r')
+        self.offsets = {}
+
+        entries = []
+        for entry in self.czi.filtered_subblock_directory:
+            dims = {dim.dimension: dim for dim in entry.dimension_entries}
+            # pyramid subblocks store fewer pixels than they cover
+            factor = max(1, round(dims['X'].size / dims['X'].stored_size))
+            entries += [(entry, dims, factor)]
+
+        def origin(dimension):
+            return min((dims[dimension].start for _, dims, _ in entries
+                        if dimension in dims), default = 0)
+
+        def index(dims, dimension, start):
+            return dims[dimension].start - start if dimension in dims else 0
+
+        c0, z0, t0, s0 = origin('C'), origin('Z'), origin('T'), origin('S')
+
+        # downsampling factor -> (channel, depth, time, scene) -> list of (entry, dims)
+        self.levels = {1: {}}
+        # scene -> (x0, y0, x1, y1) bounding box of the scene in pixels
+        self.bounds = {}
+        for entry, dims, factor in entries:
+            key = (index(dims, 'C', c0), index(dims, 'Z', z0),
+                   index(dims, 'T', t0), index(dims, 'S', s0))
+            self.levels.setdefault(factor, {}).setdefault(key, []).append((entry, dims))
+            if factor != 1:
+                continue
+
+            x, y = dims['X'], dims['Y']
+            scene = key[3]
+            bx0, by0, bx1, by1 = self.bounds.get(scene, (x.start, y.start, x.start, y.start))
+            self.bounds[scene] = (min(bx0, x.start), min(by0, y.start),
+                                  max(bx1, x.start + x.size), max(by1, y.start + y.size))
+
+        # full-resolution subblocks
+        self.planes = self.levels[1]
+        keys = self.planes.keys()
+        self.channels = max(k[0] for k in keys) + 1
+        self.depth = max(k[1] for k in keys) + 1
+        self.times = max(k[2] for k in keys) + 1
+        self.scenes = max(k[3] for k in keys) + 1
+        self.dtype = self.czi.dtype
+
+        # 12-bit acquisitions are stored in 16-bit pixels, so prefer the
+        # significant bit count recorded by the microscope
+        self.info = CziMetadata.read(self.czi, path)
+        self.bits = self.dtype.itemsize * 8
+        if self.info.bits != None and self.dtype.kind != 'f':
+            self.bits = min(self.info.bits, self.bits)
+        if self.dtype.kind == 'f':
+            self.maximum = 255.0
+        elif self.bits <= 16:
+            self.maximum = (1 << self.bits) - 1
+        else:
+            # lookup tables and histograms have an entry per level
+            self.close()
+            raise ValueError('%s: %d-bit integer pixels are not supported' % (path, self.bits))
+
+    def metadata(self):
+        return self.czi.metadata()
+
+    def channel_settings(self) -> list:
+        """
+        Return a ChannelSetting for each channel, defaults for those the metadata
+        does not describe.
+        """
+        settings = list(self.info.channels[:self.channels])
+        for cid in range(len(settings), self.channels):
+            settings += [ChannelSetting('Channel ' + str(cid), (255, 255, 255), 0, 1, 1.0, True)]
+        return settings
+
+    def plane_shape(self, scene = 0) -> tuple:
+        """
+        Return the (height, width) of a plane in the given scene.
+        """
+        x0, y0, x1, y1 = self.bounds[scene]
+        return y1 - y0, x1 - x0
+
+    def read_plane(self, c, z, t = 0, scene = 0, size = None):
+        """
+        Decode the subblocks of a single plane and return it as a 2d array.
+
+        If a (width, height) 'size' is given, the plane is resampled to it by nearest
+        neighbour while the subblocks are pasted, so a full-resolution plane is never
+        allocated. Like python sequences, negative depth indices count from the last slice.
+
+        Full-resolution planes are returned read-only from the plane cache.
+        """
+        height, width = self.plane_shape(scene)
+        if size != None:
+            return self.read_region(c, z, t, scene, (0, 0, width, height), size)
+
+        key = (scene, t, c, z % self.depth, 0)
+        plane = self.plane_cache.get(key)
+        if plane is None:
+            plane = self.plane_cache.put(key, self.read_region(c, z, t, scene, (0, 0, width, height)))
+        return plane
+
+    def read_region(self, c, z, t, scene, region, size = None, decoded = None):
+        """
+        Decode the part of a plane inside 'region' (x0, y0, x1, y1), in full-resolution
+        pixels from the top-left of the scene, resampled to a (width, height) 'size'.
+
+        Only the subblocks overlapping the region are decoded, taken from the coarsest
+        pyramid level that still has a pixel for each output pixel. Pixels outside the
+        scene are 0.
+
+        When a plane is read in strips from top to bottom, a 'decoded' dict kept
+        across the strips holds the subblocks that reach below the current strip,
+        so each subblock is decoded once per plane.
+        """
+        z = z % self.depth
+        x0, y0, x1, y1 = region
+        if size == None:
+            size = (x1 - x0, y1 - y0)
+
+        # full-resolution row and column sampled by each output pixel
+        sx, sy = (x1 - x0) / size[0], (y1 - y0) / size[1]
+        rows = npy.floor(y0 + (npy.arange(size[1]) + 0.5) * sy).astype(npy.intp)
+        cols = npy.floor(x0 + (npy.arange(size[0]) + 0.5) * sx).astype(npy.intp)
+        plane = npy.zeros((size[1], size[0]), self.dtype)
+
+        key = (c, z, t, scene)
+        cached = self.cache.plane(key) if self.cache != None else None
+        if cached is not None:
+            r0, r1 = npy.searchsorted(rows, (0, cached.shape[0]))
+            c0, c1 = npy.searchsorted(cols, (0, cached.shape[1]))
+            if r0 < r1 and c0 < c1:
+                plane[r0:r1, c0:c1] = cached[npy.ix_(rows[r0:r1], cols[c0:c1])]
+            return plane
+
+        factor = max(f for f in self.levels if f <= min(sx, sy) or f == 1)
+        subblocks = self.levels[factor].get((c, z, t, scene))
+        if subblocks == None:
+            factor, subblocks = 1, self.planes.get((c, z, t, scene), [])
+
+        bx0, by0, _, _ = self.bounds[scene]
+        overlapping = []
+        for entry, dims in subblocks:
+            top, left = dims['Y'].start - by0, dims['X'].start - bx0
+            r0, r1 = npy.searchsorted(rows, (top, top + dims['Y'].size))
+            c0, c1 = npy.searchsorted(cols, (left, left + dims['X'].size))
+            if r0 < r1 and c0 < c1:
+                overlapping += [(entry, dims, top, left, (r0, r1, c0, c1))]
+
+        def decode(subblock):
+            entry, dims, top, left, (r0, r1, c0, c1) = subblock
+            ys, xs = dims['Y'].size, dims['X'].size
+            stored_ys, stored_xs = dims['Y'].stored_size, dims['X'].stored_size
+            tile = decoded.pop(entry.file_position, None) if decoded != None else None
+            if tile is None:
+                # pyramid subblocks are read at their stored resolution
+                with timings.stage('decode'):
+                    tile = self.read_subblock(entry)
+                # keep the first sample of the pixel, as [..., 0] did for rgb data
+                tile = tile.reshape(stored_ys, stored_xs, -1)[:, :, 0]
+            if decoded != None and top + ys > y1:
+                decoded[entry.file_position] = tile
+            if (r1 - r0, c1 - c0) == (stored_ys, stored_xs) == (ys, xs):
+                return tile
+            stored_rows = (rows[r0:r1] - top) * stored_ys // ys
+            stored_cols = (cols[c0:c1] - left) * stored_xs // xs
+            return tile[stored_rows][:, stored_cols]
+
+        # tiles are pasted in directory order, so overlaps resolve as before
+        if len(overlapping) > 1: tiles = self.pool.map(decode, overlapping)
+        else: tiles = map(decode, overlapping)
+        for (_, _, _, _, (r0, r1, c0, c1)), tile in zip(overlapping, tiles):
+            plane[r0:r1, c0:c1] = tile
+
+        height, width = self.plane_shape(scene)
+        if self.cache != None and factor == 1 and (x0, y0, x1, y1) == (0, 0, width, height) \
+           and tuple(size) == (width, height):
+            self.cache.store('plane', key, plane)
+        return plane
+
+    def read_subblock(self, entry):
+        """
+        Return the stored pixels of a subblock. Uncompressed subblocks are returned
+        as a view into the map of the file, without reading or copying anything;
+        the page cache of the system serves repeated reads.
+        """
+        if entry.compression != 0:
+            return entry.data_segment().data(resize = False)
+
+        if entry.file_position not in self.offsets:
+            segment = entry.data_segment()
+            self.offsets[entry.file_position] = (segment.data_offset, segment.data_size)
+        offset, size = self.offsets[entry.file_position]
+        dtype = npy.dtype(entry.dtype)
+        tile = self.map[offset:offset + size].view(dtype.base).reshape(entry.stored_shape)
+        # rgb pixels are stored as bgr(a), czifile hands them out as rgb(a)
+        if tile.shape[-1] == 3:
+            tile = tile[..., ::-1]
+        elif tile.shape[-1] == 4:
+            tile = tile[..., [2, 1, 0, 3]]
+        return tile
+
+    def close(self):
+        self.readers.shutdown()
+        self.pool.shutdown()
+        self.map = None
+        if self.cache != None:
+            self.cache.close()
+        self.czi.close()
+
+class TilePyramid:
+    """
+    Power-of-two resolution levels of a document, cut into square tiles.
+
+    A pixel of level n covers 2**n x 2**n full-resolution pixels. Tiles are read
+    from the pyramid subblocks of the file when it carries them, and are built
+    from the full-resolution subblocks otherwise. Either way they are kept in a
+    PlaneCache of 'budget' bytes, so panning and zooming only decode the tiles
+    coming into view.
+    """
+
+    TILE_SIZE = 256
+    BUDGET = 128 << 20
+
+    def __init__(self, document, budget = BUDGET):
+        self.document = document
+        # (scene, t, c, z, level, column, row) -> tile
+        self.tiles = PlaneCache(budget)
+
+    @staticmethod
+    def level_for(scale):
+        """
+        Return the coarsest level with at least one pixel per screen pixel, when a
+        screen pixel covers 'scale' full-resolution pixels.
+        """
+        level = 0
+        while 2 ** (level + 1) <= scale:
+            level += 1
+        return level
+
+    def level_shape(self, level, scene = 0) -> tuple:
+        height, width = self.document.plane_shape(scene)
+        f = 2 ** level
+        return -(-height // f), -(-width // f)
+
+    def read(self, c, z, t, scene, level, region):
+        """
+        Return the pixels of a level inside 'region' (x0, y0, x1, y1), in level
+        coordinates. Missing tiles are decoded together, so each subblock is only
+        read once per call. Pixels outside the scene are 0.
+        """
+        z = z % self.document.depth
+        x0, y0, x1, y1 = region
+        height, width = self.level_shape(level, scene)
+        ts = TilePyramid.TILE_SIZE
+        f = 2 ** level
+
+        block = npy.zeros((y1 - y0, x1 - x0), self.document.dtype)
+        columns = range(max(x0, 0) // ts, (min(x1, width) - 1) // ts + 1)
+        rows = range(max(y0, 0) // ts, (min(y1, height) - 1) // ts + 1)
+        if len(columns) == 0 or len(rows) == 0:
+            return block
+
+        tiles = {(tx, ty): self.tiles.get((scene, t, c, z, level, tx, ty)) for ty in rows for tx in columns}
+        missing = [position for position, tile in tiles.items() if tile is None]
+        if len(missing) > 0:
+            mx0 = min(tx for tx, _ in missing) * ts
+            my0 = min(ty for _, ty in missing) * ts
+            mx1 = min((max(tx for tx, _ in missing) + 1) * ts, width)
+            my1 = min((max(ty for _, ty in missing) + 1) * ts, height)
+            region = self.document.read_region(c, z, t, scene,
+                                               (mx0 * f, my0 * f, mx1 * f, my1 * f),
+                                               (mx1 - mx0, my1 - my0))
+            for tx, ty in missing:
+                tile = region[ty * ts - my0:(ty + 1) * ts - my0, tx * ts - mx0:(tx + 1) * ts - mx0]
+                tiles[(tx, ty)] = self.tiles.put((scene, t, c, z, level, tx, ty), tile.copy())
+
+        for ty in rows:
+            for tx in columns:
+                tile = tiles[(tx, ty)]
+                # overlap of the tile with the requested region
+                left, top = tx * ts, ty * ts
+                ox0, oy0 = max(left, x0), max(top, y0)
+                ox1, oy1 = min(left + tile.shape[1], x1), min(top + tile.shape[0], y1)
+                block[oy0 - y0:oy1 - y0, ox0 - x0:ox1 - x0] = \
+                    tile[oy0 - top:oy1 - top, ox0 - left:ox1 - left]
+
+        return block
+
+    def read_view(self, c, z, t, scene, view):
+        """
+        Return the plane as seen through 'view' ((x, y), scale, (width, height)): the
+        full-resolution point at the top-left of the screen, the full-resolution pixels
+        per screen pixel, and the screen size.
+        """
+        (vx, vy), scale, (width, height) = view
+        level = self.level_for(scale)
+        f = 2 ** level
+
+        # level pixel sampled by each screen pixel
+        cols = npy.floor((vx + (npy.arange(width) + 0.5) * scale) / f).astype(npy.intp)
+        rows = npy.floor((vy + (npy.arange(height) + 0.5) * scale) / f).astype(npy.intp)
+        x0, y0 = cols[0], rows[0]
+        block = self.read(c, z, t, scene, level, (x0, y0, cols[-1] + 1, rows[-1] + 1))
+        return block[rows - y0][:, cols - x0]
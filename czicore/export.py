@@ -0,0 +1,299 @@
+"""
+Exports of documents: composed images with their channel labels, OME-TIFF
+stacks of all planes, and the batch exporter of the command line.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .document import CACHE_DIRECTORY, ChannelSetting, CziDocument
+from .render import BLEND_MODES, ChannelState, Renderer, ViewState
+
+class Labels:
+    """
+    Channel labels burned into exported images.
+
+    A label is the text of a channel in its color, stacked from the top-left
+    corner. Fonts are loaded once, and each text is rasterized once per font
+    into a mask that exports paste in the channel color. In the viewer the same
+    labels are drawn as canvas text items instead (see App.draw_labels).
+    """
+
+    SIZE = 64
+    ORIGIN = (50, 50)
+    SPACING = 80
+    MASKS = 256
+
+    fonts = {}
+    # (font name, text) -> (mask, (left, top)), least recently used first
+    masks = OrderedDict()
+    lock = threading.Lock()
+
+    @staticmethod
+    def font_name(merged) -> str:
+        return 'arialbd.ttf' if merged else 'harding.otf'
+
+    @staticmethod
+    def font(name):
+        """
+        Return the font of a file at the label size, loaded on first use. Fonts
+        missing on this system fall back to the default font of Pillow.
+        """
+        if name not in Labels.fonts:
+            try:
+                Labels.fonts[name] = ImageFont.truetype(name, Labels.SIZE)
+            except OSError:
+                Labels.fonts[name] = ImageFont.load_default(Labels.SIZE)
+        return Labels.fonts[name]
+
+    @staticmethod
+    def mask(name, text):
+        """
+        Return the 'L' mask of a text and the offset of its ink from the text origin.
+        """
+        key = (name, text)
+        with Labels.lock:
+            if key in Labels.masks:
+                Labels.masks.move_to_end(key)
+                return Labels.masks[key]
+            font = Labels.font(name)
+            left, top, right, bottom = font.getbbox(text)
+            mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)))
+            ImageDraw.Draw(mask).text((-left, -top), text, 255, font)
+            Labels.masks[key] = (mask, (left, top))
+            while len(Labels.masks) > Labels.MASKS:
+                Labels.masks.popitem(last = False)
+            return Labels.masks[key]
+
+    @staticmethod
+    def burn(image, labels, merged):
+        """
+        Draw (text, '#rrggbb') labels onto an rgb image, one line per label.
+        """
+        name = Labels.font_name(merged)
+        x, y = Labels.ORIGIN
+        for line, (text, color) in enumerate(labels):
+            if text == '':
+                continue
+            mask, (left, top) = Labels.mask(name, text)
+            x0, y0 = x + left, y + line * Labels.SPACING + top
+            image.paste(color, (x0, y0, x0 + mask.width, y0 + mask.height), mask)
+
+class StackWriter:
+    """
+    Writes every plane of a document, in its native bit depth, into a tiled and
+    compressed BigTIFF with OME metadata, one image series per scene.
+
+    Planes are read in strips of whole tile rows and handed to the writer tile
+    by tile, so memory use stays bounded by two strips, and by the subblocks that
+    cross them, however large the file is. The next strip is read on the readers
+    of the document while the writer compresses the current one. A subblock
+    taller than a strip is decoded once and cut into the strips it covers.
+    """
+
+    TILE_SIZE = 256
+    # upper bound of a strip, it is never less than one row of tiles
+    STRIP_BYTES = 64 << 20
+
+    def __init__(self, document):
+        self.document = document
+
+    def strip_rows(self, scene = 0) -> int:
+        """
+        Return the number of rows read at once from the planes of a scene.
+        """
+        height, width = self.document.plane_shape(scene)
+        tiles = self.STRIP_BYTES // (width * self.document.dtype.itemsize * self.TILE_SIZE)
+        return self.TILE_SIZE * max(1, tiles)
+
+    def tiles(self, scene = 0):
+        """
+        Yield the tiles of all planes of a scene in the order of the file: time,
+        depth and channel, then rows and columns of tiles.
+        """
+        document = self.document
+        height, width = document.plane_shape(scene)
+        rows = self.strip_rows(scene)
+        # (c, z, t, y, subblocks decoded for the strips below), one dict per plane
+        strips = []
+        for t in range(document.times):
+            for z in range(document.depth):
+                for c in range(document.channels):
+                    decoded = {}
+                    strips += [(c, z, t, y, decoded) for y in range(0, height, rows)]
+
+        def read(strip):
+            c, z, t, y, decoded = strip
+            return document.read_region(c, z, t, scene, (0, y, width, min(y + rows, height)),
+                                        decoded = decoded)
+
+        following = document.readers.submit(read, strips[0])
+        for i in range(len(strips)):
+            strip = following.result()
+            if i + 1 < len(strips):
+                following = document.readers.submit(read, strips[i + 1])
+            for ty in range(0, strip.shape[0], self.TILE_SIZE):
+                for tx in range(0, width, self.TILE_SIZE):
+                    yield strip[ty:ty + self.TILE_SIZE, tx:tx + self.TILE_SIZE]
+
+    def write(self, fn, compression = 'zlib'):
+        """
+        Write the document to 'fn', naming the channels after their display settings.
+        """
+        import tifffile
+
+        names = [setting.name for setting in self.document.channel_settings()]
+        document = self.document
+        with tifffile.TiffWriter(fn, bigtiff = True, ome = True) as tif:
+            for scene in range(document.scenes):
+                height, width = document.plane_shape(scene)
+                tif.write(self.tiles(scene),
+                          shape = (document.times, document.depth, document.channels, height, width),
+                          dtype = document.dtype, tile = (self.TILE_SIZE, self.TILE_SIZE),
+                          compression = compression,
+                          metadata = {'axes': 'TZCYX', 'Name': 'Scene ' + str(scene),
+                                      'Channel': {'Name': names},
+                                      'SignificantBits': document.bits})
+
+def save_export(fn, image, planes):
+    """
+    Save a composed image, and each of its (cid, plane) channels next to it as
+    'name.cid.tiff' in their native bit depth (16-bit tiff for 12/16-bit data).
+    """
+    image.save(fn)
+    root, _ = os.path.splitext(fn)
+    for cid, plane in planes:
+        Image.fromarray(plane).save(root + '.' + str(cid) + '.tiff')
+
+def read_preset(fn):
+    """
+    Read channel settings from a json preset: a list (or the 'channels' entry of
+    an object) with one object per channel holding any of 'name', 'color'
+    ('#RRGGBB'), 'low', 'high', 'gamma' and 'visible'. Missing channels and
+    fields fall back to the settings saved in each file.
+    """
+    with open(fn) as f:
+        preset = json.load(f)
+    if isinstance(preset, dict):
+        preset = preset.get('channels', [])
+    return preset
+
+def batch_settings(document, preset = None):
+    """
+    Return the ChannelSettings of a document with a preset applied over them.
+    """
+    settings = document.channel_settings()
+    for cid, entry in enumerate((preset or [])[:len(settings)]):
+        fields = {key: entry[key] for key in ChannelSetting._fields if key in entry}
+        if 'color' in fields:
+            color = int(str(fields['color']).lstrip('#')[-6:], base = 16)
+            fields['color'] = ((color >> 16) & 0xff, (color >> 8) & 0xff, color & 0xff)
+        settings[cid] = settings[cid]._replace(**fields)
+    return settings
+
+def check_index(name, index, count, negative = False):
+    """
+    Raise a ValueError unless 0 <= index < count, or -count <= index if 'negative'.
+    """
+    lowest = -count if negative else 0
+    if not lowest <= index < count:
+        raise ValueError('%s %d is out of range %d..%d of the file' % (name, index, lowest, count - 1))
+
+def batch_export(task):
+    """
+    Export one CZI file of a batch: the composed png and its channel tiffs, or
+    the stack of all its planes. Runs in a worker process, so failures are
+    returned rather than raised.
+
+    Returns (path, seconds, error).
+    """
+    path, output, preset, z, zrange, mode, t, scene, stack, cache, threads = task
+    began = time.perf_counter()
+    try:
+        document = CziDocument(path, cache = cache, workers = threads)
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            if stack:
+                StackWriter(document).write(os.path.join(output, name + '.ome.tif'))
+                return path, time.perf_counter() - began, None
+
+            channels = tuple(ChannelState(cid, setting.low, setting.high, setting.color,
+                                          setting.gamma, setting.visible)
+                             for cid, setting in enumerate(batch_settings(document, preset)))
+            merged = zrange != None
+            zstart, zend = zrange if merged else (z, z)
+            # only -z counts from the top, other indices must be in the file
+            check_index('z level', z, document.depth, negative = True)
+            for level in zrange or ():
+                check_index('z level', level, document.depth)
+            check_index('time point', t, document.times)
+            check_index('scene', scene, document.scenes)
+            state = ViewState(None, merged, z % document.depth, zstart % document.depth,
+                              zend % document.depth, mode, channels, t, scene)
+            rgb, planes = Renderer(document).render(state)
+            save_export(os.path.join(output, name + '.png'), Image.fromarray(rgb), planes)
+        finally:
+            document.close()
+    except Exception as e:
+        return path, time.perf_counter() - began, '%s: %s' % (type(e).__name__, e)
+    return path, time.perf_counter() - began, None
+
+def batch(argv = None):
+    """
+    Command-line entry point: export every CZI file of a directory without the
+    gui, spreading the files over worker processes.
+    """
+    parser = argparse.ArgumentParser(description = 'Export the CZI files of a directory.')
+    parser.add_argument('directory', help = 'directory holding the .czi files')
+    parser.add_argument('-o', '--output', help = 'output directory (default: the input directory)')
+    parser.add_argument('-p', '--preset', help = 'json file with channel settings to use instead of '
+                                                 'the ones saved in each file')
+    parser.add_argument('-z', type = int, default = 0,
+                        help = 'z level to export, from 0; negative counts from the top')
+    parser.add_argument('--project', type = int, nargs = 2, metavar = ('ZFROM', 'ZTO'),
+                        help = 'merge the z levels from ZFROM to ZTO instead of exporting one')
+    parser.add_argument('-m', '--mode', default = 'Maximum (Lighten)', choices = tuple(BLEND_MODES),
+                        help = 'layer merge mode of --project')
+    parser.add_argument('--time', type = int, default = 0, help = 'time point to export, from 0')
+    parser.add_argument('--scene', type = int, default = 0, help = 'scene to export, from 0')
+    parser.add_argument('--stack', action = 'store_true',
+                        help = 'write all planes of each file to a tiled OME-TIFF instead')
+    parser.add_argument('--cache', default = CACHE_DIRECTORY,
+                        help = 'directory to keep decoded planes in (default: $CZI_CACHE)')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(),
+                        help = 'number of worker processes (default: one per core)')
+    parser.add_argument('-t', '--threads', type = int,
+                        help = 'subblock decoding threads per process (default: cores / jobs)')
+    args = parser.parse_args(argv)
+
+    output = args.output or args.directory
+    os.makedirs(output, exist_ok = True)
+    preset = read_preset(args.preset) if args.preset else None
+    files = sorted(os.path.join(args.directory, fn) for fn in os.listdir(args.directory)
+                   if fn.lower().endswith('.czi'))
+    jobs = max(1, min(args.jobs, len(files)))
+    threads = args.threads or max(1, os.cpu_count() // jobs)
+    tasks = [(fn, output, preset, args.z, args.project, args.mode, args.time, args.scene,
+              args.stack, args.cache, threads) for fn in files]
+
+    # one file per process at a time; a single job stays in this process
+    if jobs > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(pool.imap_unordered(batch_export, tasks, chunksize = 1))
+    else: results = [batch_export(task) for task in tasks]
+
+    failed = 0
+    for path, seconds, error in sorted(results):
+        if error != None:
+            failed += 1
+            print('%s: failed, %s' % (path, error), file = sys.stderr)
+        else: print('%s: %.2f s' % (path, seconds))
+    return 1 if failed > 0 else 0
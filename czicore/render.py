@@ -0,0 +1,711 @@
+"""
+Rendering of documents: z-merges with the blend modes of the merge selector,
+histograms, and composition of channels into rgb images.
+"""
+
+import threading
+from collections import namedtuple
+from collections import OrderedDict
+
+import numpy as npy
+
+from .document import CacheStats, PlaneCache, TilePyramid, file_identity
+from .timing import timings
+
+# a snapshot of everything a render depends on, taken from the widgets on the Tk
+# thread; 'view' is None for full resolution, 'channels' holds a ChannelState per channel
+ViewState = namedtuple('ViewState', ['view', 'merged', 'z', 'zstart', 'zend', 'mode', 'channels',
+                                     't', 'scene'], defaults = (0, 0))
+ChannelState = namedtuple('ChannelState', ['cid', 'low', 'high', 'color', 'gamma', 'visible'])
+
+# float planes have no integer levels to index tables and histograms with, they
+# are quantized to this many steps between 0 and the white level instead
+FLOAT_STEPS = 1 << 16
+
+def quantize(plane, white):
+    """
+    Return a float plane as uint16 steps of white / (FLOAT_STEPS - 1), clipped to
+    [0, white] and with nan as 0. Integer planes are returned as they are.
+    """
+    if plane.dtype.kind != 'f':
+        return plane
+    steps = npy.multiply(plane, npy.float32((FLOAT_STEPS - 1) / white), dtype = npy.float32)
+    npy.clip(steps, 0, FLOAT_STEPS - 1, out = steps)
+    npy.nan_to_num(steps, copy = False)
+    return npy.rint(steps, out = steps).astype(npy.uint16)
+
+class Compositor:
+    """
+    Composes integer channel planes into an rgb image through lookup tables.
+
+    Each channel gets a table with one entry per pixel value of its type (256 for
+    8-bit, 65536 for 16-bit data) holding the uint8 rgb contribution of that
+    value, so mapping a plane costs one table lookup per pixel. Float planes are
+    quantized to FLOAT_STEPS entries between 0 and white first. Contributions
+    are summed into a reused uint16 buffer and saturated at white.
+
+    For the viewer, layer() keeps the contribution of each channel with the
+    source of its plane and its table, and compose_layers() keeps their running
+    sum: a channel is only looked up again when its plane or table changed, and
+    the sum only subtracts and adds the contributions that changed.
+    """
+
+    def __init__(self):
+        # channel key -> (settings, table)
+        self.tables = {}
+        # shape -> (accumulator, lookup scratch, uint8 output)
+        self.buffers = {}
+        # channel key -> (source, table, plane, contribution)
+        self.layers = {}
+        # (uint16 running sum, uint8 output) of the viewer, and the contribution
+        # of each channel key that is included in the sum
+        self.sum = None
+        self.summed = {}
+
+    def table(self, key, dtype, white, low, high, color, gamma = 1.0):
+        """
+        Return the lookup table of a channel, rebuilding it only if its settings changed.
+
+        'low' and 'high' are fractions of the white level, 'color' is an (r, g, b) triple
+        in 0-255 and 'gamma' is applied to the levelled intensity.
+        """
+        dtype = npy.dtype(dtype)
+        settings = (dtype, white, low, high, tuple(color[:3]), gamma)
+        cached = self.tables.get(key)
+        if cached != None and cached[0] == settings:
+            return cached[1]
+
+        if dtype.kind == 'f':
+            values = npy.arange(FLOAT_STEPS) / (FLOAT_STEPS - 1)
+        else:
+            size = 1 << (8 * dtype.itemsize) if dtype.itemsize <= 2 else white + 1
+            values = npy.arange(size) / white
+        if high > low:
+            linear = npy.clip((values - low) / (high - low), 0, 1)
+        else:
+            linear = npy.float64(values > high)
+        if gamma != 1.0:
+            linear = linear ** gamma
+
+        table = npy.rint(linear[:, None] * npy.array(color[:3], npy.float64))
+        table = npy.uint8(npy.clip(table, 0, 255))
+        self.tables[key] = (settings, table)
+        return table
+
+    def lookup(self, key, plane, out = None):
+        """
+        Return the contribution of a plane through the table of channel 'key'.
+        """
+        settings, table = self.tables[key]
+        return npy.take(table, quantize(plane, settings[1]), axis = 0, out = out, mode = 'clip')
+
+    def compose(self, layers, shape):
+        """
+        Sum the table lookups of (channel key, plane) pairs into an rgb uint8 array of the given (height, width).
+
+        The returned array is an internal buffer, overwritten by the next call.
+        """
+        shape = tuple(shape)
+        if shape not in self.buffers:
+            # only the buffers of the latest image size are kept
+            self.buffers = {shape: (npy.empty(shape + (3,), npy.uint16),
+                                    npy.empty(shape + (3,), npy.uint8),
+                                    npy.empty(shape + (3,), npy.uint8))}
+        acc, lookup, out = self.buffers[shape]
+
+        acc.fill(0)
+        for key, plane in layers:
+            self.lookup(key, plane, out = lookup)
+            npy.add(acc, lookup, out = acc)
+
+        npy.minimum(acc, 255, out = acc)
+        npy.copyto(out, acc, casting = 'unsafe')
+        return out
+
+    def has(self, key, source, table = None) -> bool:
+        """
+        Return whether the contribution of a channel is up to date with the source
+        of its plane and, if given, its table.
+        """
+        cached = self.layers.get(key)
+        return cached != None and cached[0] == source and (table is None or cached[1] is table)
+
+    def layer(self, key, source, table, plane = None):
+        """
+        Update the contribution of a channel, whose plane comes from 'source' (any
+        key that changes with its content). The plane is only needed if has(key,
+        source) is false; when only the table changed, the kept plane is looked
+        up again. Returns the plane.
+        """
+        if self.has(key, source, table):
+            return self.layers[key][2]
+        if plane is None:
+            plane = self.layers[key][2]
+        contribution = self.lookup(key, plane)
+        self.layers[key] = (source, table, plane, contribution)
+        return plane
+
+    def compose_layers(self, keys, shape):
+        """
+        Return the sum of the contributions of the channel keys as an rgb uint8
+        array of the given (height, width), updating the running sum by the
+        contributions that changed since the last call.
+
+        The returned array is an internal buffer, overwritten by the next call.
+        """
+        shape = tuple(shape)
+        if self.sum == None or self.sum[0].shape[:2] != shape:
+            self.sum = (npy.zeros(shape + (3,), npy.uint16), npy.empty(shape + (3,), npy.uint8))
+            self.summed = {}
+        acc, out = self.sum
+
+        # hidden and changed contributions leave the sum, then new ones enter it
+        for key in list(self.summed):
+            if key not in keys or self.summed[key] is not self.layers[key][3]:
+                npy.subtract(acc, self.summed.pop(key), out = acc)
+        for key in keys:
+            if key not in self.summed:
+                self.summed[key] = self.layers[key][3]
+                npy.add(acc, self.summed[key], out = acc)
+
+        npy.minimum(acc, 255, out = out, casting = 'unsafe')
+        return out
+
+# Blend kernels merge a depth slice 'l' into the running merge 'm' in place.
+# Both are float32 arrays in [0, 1] of the same shape, and 's' holds three float32
+# scratch arrays and one bool scratch array of that shape. Each kernel performs
+# the float operations of its formula in the same order as the formula, so
+# results are bit for bit those of evaluating it with temporaries.
+
+def blend_maximum(m, l, s):
+    npy.maximum(m, l, out = m)
+
+def blend_minimum(m, l, s):
+    npy.minimum(m, l, out = m)
+
+def blend_multiply(m, l, s):
+    npy.multiply(m, l, out = m)
+
+def blend_screen(m, l, s):
+    # 1 - (1 - m) * (1 - l)
+    npy.subtract(1, m, out = m)
+    npy.subtract(1, l, out = s[0])
+    npy.multiply(m, s[0], out = m)
+    npy.subtract(1, m, out = m)
+
+def blend_color_burn(m, l, s):
+    # 1 - (1 - m) / (l + 1e-5)
+    npy.subtract(1, m, out = m)
+    npy.add(l, 1e-5, out = s[0])
+    npy.divide(m, s[0], out = m)
+    npy.subtract(1, m, out = m)
+
+def blend_color_dodge(m, l, s):
+    # m / (1 - l + 1e-5)
+    npy.subtract(1, l, out = s[0])
+    npy.add(s[0], 1e-5, out = s[0])
+    npy.divide(m, s[0], out = m)
+
+def blend_linear_burn(m, l, s):
+    # l + m - 1
+    npy.add(l, m, out = m)
+    npy.subtract(m, 1, out = m)
+
+def blend_linear_dodge(m, l, s):
+    npy.add(l, m, out = m)
+
+def blend_linear_light(m, l, s):
+    # 2 * l + m - 1
+    npy.multiply(2, l, out = s[0])
+    npy.add(s[0], m, out = m)
+    npy.subtract(m, 1, out = m)
+
+def blend_light(m, l, s):
+    # where s[3]: 2 * l * m, elsewhere: 1 - 2 * (1 - l) * (1 - m)
+    mask = s[3]
+    npy.multiply(2, l, out = s[0])
+    npy.multiply(s[0], m, out = s[0])
+    npy.subtract(1, l, out = s[1])
+    npy.multiply(2, s[1], out = s[1])
+    npy.subtract(1, m, out = s[2])
+    npy.multiply(s[1], s[2], out = s[1])
+    npy.subtract(1, s[1], out = s[1])
+    npy.copyto(m, s[0], where = mask)
+    npy.logical_not(mask, out = mask)
+    npy.copyto(m, s[1], where = mask)
+
+def blend_overlay(m, l, s):
+    npy.less_equal(m, 0.5, out = s[3])
+    blend_light(m, l, s)
+
+def blend_hard_light(m, l, s):
+    npy.less_equal(l, 0.5, out = s[3])
+    blend_light(m, l, s)
+
+def blend_soft_light(m, l, s):
+    # l <= 0.5: 2 * l * m + m * m * (1 - 2 * l), else 2 * m * (1 - l) + sqrt(m) * (2 * l - 1)
+    mask = s[3]
+    npy.less_equal(l, 0.5, out = mask)
+    npy.multiply(2, l, out = s[0])
+    npy.subtract(1, s[0], out = s[1])
+    npy.multiply(s[0], m, out = s[0])
+    npy.multiply(m, m, out = s[2])
+    npy.multiply(s[2], s[1], out = s[2])
+    npy.add(s[0], s[2], out = s[0])
+    npy.copyto(m, s[0], where = mask)
+    # the second branch only reads m where the first one left it untouched
+    npy.multiply(2, m, out = s[0])
+    npy.subtract(1, l, out = s[1])
+    npy.multiply(s[0], s[1], out = s[0])
+    npy.sqrt(m, out = s[2])
+    npy.multiply(2, l, out = s[1])
+    npy.subtract(s[1], 1, out = s[1])
+    npy.multiply(s[2], s[1], out = s[2])
+    npy.add(s[0], s[2], out = s[0])
+    npy.logical_not(mask, out = mask)
+    npy.copyto(m, s[0], where = mask)
+
+def blend_vivid_light(m, l, s):
+    # l <= 0.5: 1 + (m - 1) / (2 * l + 1e-5), else m / (2 * (1 - l) + 1e-5)
+    mask = s[3]
+    npy.less_equal(l, 0.5, out = mask)
+    npy.multiply(2, l, out = s[0])
+    npy.add(s[0], 1e-5, out = s[0])
+    npy.subtract(m, 1, out = s[1])
+    npy.divide(s[1], s[0], out = s[1])
+    npy.add(1, s[1], out = s[1])
+    npy.subtract(1, l, out = s[0])
+    npy.multiply(2, s[0], out = s[0])
+    npy.add(s[0], 1e-5, out = s[0])
+    npy.divide(m, s[0], out = s[0])
+    npy.copyto(m, s[1], where = mask)
+    npy.logical_not(mask, out = mask)
+    npy.copyto(m, s[0], where = mask)
+
+def blend_pin_light(m, l, s):
+    # l <= 0.5: min(2 * l, m), else max(2 * (l - 0.5), m)
+    mask = s[3]
+    npy.less_equal(l, 0.5, out = mask)
+    npy.multiply(2, l, out = s[0])
+    npy.minimum(s[0], m, out = s[0])
+    npy.subtract(l, 0.5, out = s[1])
+    npy.multiply(2, s[1], out = s[1])
+    npy.maximum(s[1], m, out = s[1])
+    npy.copyto(m, s[0], where = mask)
+    npy.logical_not(mask, out = mask)
+    npy.copyto(m, s[1], where = mask)
+
+def blend_hard_mix(m, l, s):
+    # 1 where l + m >= 1, else 0
+    npy.add(l, m, out = s[0])
+    npy.greater_equal(s[0], 1, out = s[3])
+    npy.copyto(m, s[3])
+
+def blend_difference(m, l, s):
+    npy.subtract(m, l, out = m)
+    npy.absolute(m, out = m)
+
+def blend_exclusion(m, l, s):
+    # l + m - 2 * l * m
+    npy.multiply(2, l, out = s[0])
+    npy.multiply(s[0], m, out = s[0])
+    npy.add(l, m, out = m)
+    npy.subtract(m, s[0], out = m)
+
+def blend_subtract(m, l, s):
+    npy.subtract(m, l, out = m)
+
+def blend_divide(m, l, s):
+    # m / (l + 1e-5)
+    npy.add(l, 1e-5, out = s[0])
+    npy.divide(m, s[0], out = m)
+
+# merge modes in the order of the mode selector; associative modes give the same
+# clipped result however slices are grouped, so ZProjector can cache them
+BlendMode = namedtuple('BlendMode', ['kernel', 'associative'])
+BLEND_MODES = {
+    'Maximum (Lighten)': BlendMode(blend_maximum, True),
+    'Minimum (Darken)': BlendMode(blend_minimum, True),
+    'Screen': BlendMode(blend_screen, True),
+    'Color Burn': BlendMode(blend_color_burn, False),
+    'Color Dodge': BlendMode(blend_color_dodge, False),
+    'Linear Burn': BlendMode(blend_linear_burn, True),
+    'Linear Dodge': BlendMode(blend_linear_dodge, True),
+    'Overlay': BlendMode(blend_overlay, False),
+    'Hard Light': BlendMode(blend_hard_light, False),
+    'Soft Light': BlendMode(blend_soft_light, False),
+    'Vivid Light': BlendMode(blend_vivid_light, False),
+    'Linear Light': BlendMode(blend_linear_light, False),
+    'Pin Light': BlendMode(blend_pin_light, False),
+    'Hard Mix': BlendMode(blend_hard_mix, False),
+    'Difference': BlendMode(blend_difference, False),
+    'Exclusion': BlendMode(blend_exclusion, True),
+    'Substract': BlendMode(blend_subtract, False),
+    'Multiply': BlendMode(blend_multiply, True),
+    'Divide': BlendMode(blend_divide, False),
+}
+
+class Blender:
+    """
+    Merges (c, y, x) float32 layers in place with the kernel of a blend mode,
+    clipping to [0, 1] after each slice like the z-merge always did.
+
+    The mode is dispatched once, and layers are processed in bands of CHUNK_ROWS
+    rows, so the scratch memory stays bounded whatever the image size.
+    """
+
+    CHUNK_ROWS = 64
+
+    def __init__(self, mode):
+        self.kernel = BLEND_MODES[mode].kernel
+        self.scratch = None
+
+    def blend(self, merged, layer):
+        c, y, x = merged.shape
+        rows = min(Blender.CHUNK_ROWS, y)
+        if self.scratch == None or self.scratch[0].shape != (c, rows, x):
+            self.scratch = (npy.empty((c, rows, x), npy.float32),
+                            npy.empty((c, rows, x), npy.float32),
+                            npy.empty((c, rows, x), npy.float32),
+                            npy.empty((c, rows, x), npy.bool_))
+
+        for r0 in range(0, y, rows):
+            r1 = min(r0 + rows, y)
+            m = merged[:, r0:r1]
+            self.kernel(m, layer[:, r0:r1], [s[:, :r1 - r0] for s in self.scratch])
+            npy.clip(m, 0, 1, out = m)
+        return merged
+
+class ZProjector:
+    """
+    Incremental z-merges for the associative blend modes, over a segment tree.
+
+    A node of the tree holds the merge of the depth slices [lo, hi) of one channel
+    for a view and mode, and any z range is the merge of O(log Z) nodes. Moving the
+    z range thus combines a few cached nodes instead of every slice, changing the
+    levels or colors of a channel does not touch the projection at all, and hidden
+    channels are neither read nor merged. Channels are merged in parallel on the
+    readers of the document. Nodes are
+    kept in a least-recently-used cache bounded to 'budget' bytes; single slices
+    are not cached here, they come from the tile pyramid.
+    """
+
+    def __init__(self, renderer, budget = 256 << 20):
+        self.renderer = renderer
+        self.budget = budget
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        # ((view, t, scene, c), mode, lo, hi) -> merged (1, y, x) float32 layer
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def project(self, view, mode, startz, endz, t = 0, scene = 0, channels = None):
+        """
+        Return the merge of the depth slices from startz to endz (in either order)
+        of the given channels, all of them by default, as a (c, y, x) array.
+        """
+        if channels == None:
+            channels = range(self.renderer.document.channels)
+        lo, hi = min(startz, endz), max(startz, endz) + 1
+
+        def merge(c):
+            parts = []
+            self.__cover((view, t, scene, c), mode, 0, self.renderer.document.depth, lo, hi, parts)
+            merged = parts[0] if len(parts) == 1 else parts[0].copy()
+            blender = Blender(mode)
+            for part in parts[1:]:
+                blender.blend(merged, part)
+            return merged
+
+        return npy.concatenate(list(self.renderer.document.readers.map(merge, channels)))
+
+    def __cover(self, view, mode, lo, hi, qlo, qhi, parts):
+        if qhi <= lo or hi <= qlo:
+            return
+        if qlo <= lo and hi <= qhi:
+            parts += [self.__node(view, mode, lo, hi)]
+            return
+        mid = (lo + hi) // 2
+        self.__cover(view, mode, lo, mid, qlo, qhi, parts)
+        self.__cover(view, mode, mid, hi, qlo, qhi, parts)
+
+    def __node(self, view, mode, lo, hi):
+        if hi - lo == 1:
+            view, t, scene, c = view
+            return self.renderer.read_layer(lo, view, t, scene, [c])
+
+        key = (view, mode, lo, hi)
+        with self.lock:
+            if key in self.nodes:
+                self.hits += 1
+                self.nodes.move_to_end(key)
+                return self.nodes[key]
+            self.misses += 1
+
+        mid = (lo + hi) // 2
+        node = self.__node(view, mode, lo, mid).copy()
+        Blender(mode).blend(node, self.__node(view, mode, mid, hi))
+        with self.lock:
+            if key not in self.nodes:
+                self.size += node.nbytes
+            self.nodes[key] = node
+            while self.size > self.budget and len(self.nodes) > 1:
+                _, evicted = self.nodes.popitem(last = False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+        return node
+
+class Histograms:
+    """
+    Histograms of the planes of a document, computed when first asked for.
+
+    Counts are taken with bincount on the native integer data, one bin per
+    value of the bit depth, and cached per plane in a PlaneCache of 'budget'
+    bytes (512 KB per 16-bit plane); coarser histograms for display are folded
+    from them.
+    """
+
+    # rows counted at once, bincount works on an intp copy of them
+    CHUNK_ROWS = 256
+
+    def __init__(self, document, budget = 64 << 20):
+        self.document = document
+        # (scene, t, c, z) -> counts
+        self.counts = PlaneCache(budget)
+
+    def plane(self, c, z, t = 0, scene = 0):
+        """
+        Return the full bit depth histogram of a plane, with maximum + 1 bins, or
+        FLOAT_STEPS bins for float data. Values above the white level are counted
+        in the last bin.
+        """
+        z = z % self.document.depth
+        key = (scene, t, c, z)
+        counts = self.counts.get(key)
+        if counts is not None:
+            return counts
+
+        cache = self.document.cache
+        counts = cache.load('histogram', (c, z, t, scene)) if cache != None else None
+        if counts is not None:
+            return self.counts.put(key, counts)
+
+        white = self.document.maximum
+        size = FLOAT_STEPS if self.document.dtype.kind == 'f' else white + 1
+        counts = npy.zeros(size, npy.int64)
+        plane = self.document.read_plane(c, z, t, scene)
+        for r0 in range(0, plane.shape[0], Histograms.CHUNK_ROWS):
+            rows = quantize(plane[r0:r0 + Histograms.CHUNK_ROWS], white)
+            band = npy.bincount(rows.ravel(), minlength = size)
+            counts += band[:size]
+            counts[-1] += band[size:].sum()
+
+        if cache != None:
+            cache.store('histogram', (c, z, t, scene), counts)
+        return self.counts.put(key, counts)
+
+    def has(self, z, t = 0, scene = 0) -> bool:
+        z = z % self.document.depth
+        return all((scene, t, c, z) in self.counts for c in range(self.document.channels))
+
+    def slice(self, z, t = 0, scene = 0, bins = 256):
+        """
+        Return the histograms of all channels of a depth slice, folded to 'bins' bins.
+        """
+        hists = []
+        with timings.stage('histogram'):
+            # channels are decoded and counted in parallel
+            for counts in self.document.readers.map(lambda c: self.plane(c, z, t, scene),
+                                                    range(self.document.channels)):
+                edges = npy.arange(bins) * len(counts) // bins
+                hists += [npy.add.reduceat(counts, edges)]
+        return hists
+
+class Renderer:
+    """
+    Renders view states of a document into rgb images.
+
+    Planes are read at full resolution, or through a view from the tile
+    pyramid, then z-merged and composed by a Compositor. A renderer holds
+    no Tk state, so it can run on a worker thread.
+
+    Rendered views are also kept as frames, shared by all renderers and keyed by
+    the identity of the file and everything in the view state the image depends
+    on, so going back to a view shown before costs a cache lookup.
+    """
+
+    # read-only rgb frames of views, least recently used evicted first
+    frames = PlaneCache(128 << 20)
+
+    def __init__(self, document):
+        self.document = document
+        self.identity = file_identity(document.path)
+        self.pyramid = TilePyramid(document)
+        self.compositor = Compositor()
+        self.projector = ZProjector(self)
+        self.histograms = Histograms(document)
+
+    def read_plane(self, cid, z, view = None, t = 0, scene = 0):
+        """
+        Read a channel plane at full resolution, or as seen through a view from
+        the tile pyramid.
+        """
+        if view == None:
+            return self.document.read_plane(cid, z, t, scene)
+        return self.pyramid.read_view(cid, z, t, scene, view)
+
+    def read_layer(self, z, view = None, t = 0, scene = 0, channels = None):
+        """
+        Read the channels of a depth slice, all of them by default, scaled to [0, 1]
+        in single precision for blending. Several channels are read in parallel
+        on the readers of the document, a single one on the calling thread.
+        """
+        if channels == None:
+            channels = range(self.document.channels)
+        if len(channels) > 1:
+            planes = self.document.readers.map(lambda cid: self.read_plane(cid, z, view, t, scene), channels)
+        else: planes = [self.read_plane(cid, z, view, t, scene) for cid in channels]
+        layer = npy.stack(list(planes))
+        return npy.multiply(layer, npy.float32(1 / self.document.maximum), dtype = npy.float32)
+
+    def merge_layers(self, state, channels):
+        """
+        Blend the given channels over the z range of a view state with its merge mode.
+
+        Returns a (len(channels), y, x) float32 array in [0, 1].
+        """
+        # views are merged from the segment tree when the mode allows it, full
+        # resolution exports are merged slice by slice to keep memory flat
+        if state.view != None and BLEND_MODES[state.mode].associative:
+            return self.projector.project(state.view, state.mode, state.zstart, state.zend,
+                                          state.t, state.scene, channels)
+
+        startz = state.zstart
+        endz = state.zend
+        if startz < endz: zrange = range(startz, endz + 1, 1)
+        if startz > endz: zrange = range(startz, endz - 1, -1)
+        if startz == endz: zrange = [startz]
+
+        mergenp = self.read_layer(zrange[0], state.view, state.t, state.scene, channels) # c, y, x
+
+        blender = Blender(state.mode)
+        for z in zrange[1:]:
+            blender.blend(mergenp, self.read_layer(z, state.view, state.t, state.scene, channels))
+
+        return mergenp
+
+    def visible_planes(self, state, channels = None):
+        """
+        Return (cid, plane) pairs of the given channels of a view state, by default
+        the visible ones, at its depth or z-merged. Hidden channels are neither read
+        nor merged. Planes are in the native integer type, at full resolution or as
+        seen through the view of the state.
+        """
+        if channels == None:
+            channels = [channel.cid for channel in state.channels if channel.visible]
+        if len(channels) == 0:
+            return []
+
+        planes = []
+        if state.merged:
+            mergenp = self.merge_layers(state, channels)
+            for i, cid in enumerate(channels):
+                native = mergenp[i] * self.document.maximum
+                if self.document.dtype.kind != 'f':
+                    native = npy.rint(native)
+                planes += [(cid, native.astype(self.document.dtype))]
+        else:
+            for cid in channels:
+                planes += [(cid, self.read_plane(cid, state.z, state.view, state.t, state.scene))]
+        return planes
+
+    @staticmethod
+    def source(state) -> tuple:
+        """
+        Return what the planes of a view state depend on besides their channel.
+        """
+        if state.merged:
+            return (state.view, state.t, state.scene, True, state.zstart, state.zend, state.mode)
+        return (state.view, state.t, state.scene, False, state.z)
+
+    def frame_key(self, state) -> tuple:
+        """
+        Return the key of the frame of a view state. Settings that do not show,
+        such as those of hidden channels, are left out.
+        """
+        channels = tuple((channel.cid, channel.low, channel.high, channel.color, channel.gamma)
+                         for channel in state.channels if channel.visible)
+        return (self.identity, self.source(state), channels)
+
+    def cached_frame(self, state):
+        """
+        Return the frame of a view state rendered before, or None.
+        """
+        return self.frames.get(self.frame_key(state))
+
+    def render_frame(self, state):
+        """
+        Render a view state and keep it as a frame. Returns a read-only rgb array.
+        """
+        rgb, _ = self.render(state)
+        return self.frames.put(self.frame_key(state), rgb.copy())
+
+    def frame(self, state):
+        """
+        Return the rgb frame of a view state, rendered unless it is cached.
+        """
+        rgb = self.cached_frame(state)
+        if rgb is None:
+            rgb = self.render_frame(state)
+        return rgb
+
+    def render(self, state):
+        """
+        Compose the visible channels of a view state into an rgb uint8 array.
+        The array is reused by the next render.
+        """
+        if state.view == None:
+            height, width = self.document.plane_shape(state.scene)
+            size = (width, height)
+        else: _, _, size = state.view
+
+        tables = {}
+        with timings.stage('levels'):
+            for channel in state.channels:
+                if channel.visible:
+                    tables[channel.cid] = self.compositor.table(channel.cid, self.document.dtype,
+                                                                self.document.maximum, channel.low,
+                                                                channel.high, channel.color, channel.gamma)
+
+        # full resolution is composed in one pass, keeping a contribution per
+        # channel would multiply the memory of an export
+        if state.view == None:
+            with timings.stage('z-merge' if state.merged else 'read'):
+                planes = self.visible_planes(state)
+            with timings.stage('compose'):
+                rgb = self.compositor.compose(planes, (size[1], size[0]))
+            return rgb, planes
+
+        # views only read the channels whose plane changed, and only look up
+        # those whose plane or table changed
+        source = self.source(state)
+        stale = [cid for cid in tables if not self.compositor.has(cid, source)]
+        with timings.stage('z-merge' if state.merged else 'read'):
+            read = dict(self.visible_planes(state, stale))
+        with timings.stage('compose'):
+            planes = [(cid, self.compositor.layer(cid, source, tables[cid], read.get(cid)))
+                      for cid in tables]
+            rgb = self.compositor.compose_layers(list(tables), (size[1], size[0]))
+        return rgb, planes
+
+    def stats(self) -> dict:
+        """
+        Return name -> CacheStats of the caches behind this renderer.
+        """
+        projector = self.projector
+        return {'planes': self.document.plane_cache.stats(),
+                'tiles': self.pyramid.tiles.stats(),
+                'frames': self.frames.stats(),
+                'histograms': self.histograms.counts.stats(),
+                'z-merge': CacheStats(projector.hits, projector.misses, projector.evictions,
+                                      len(projector.nodes), projector.size, projector.budget)}
@@ -0,0 +1,65 @@
+"""
+Stage timings of opening and rendering documents.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+class Timings:
+    """
+    Durations of the stages of opening and rendering, kept for the stats overlay
+    and the render log.
+
+    Stages are timed with 'with timings.stage(name):' from any thread; the most
+    recent EVENTS durations are kept, each with its wall-clock time and thread.
+    """
+
+    EVENTS = 10000
+
+    def __init__(self):
+        # (wall-clock time, stage, seconds, thread name), oldest first
+        self.events = deque(maxlen = Timings.EVENTS)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - began)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.events.append((time.time(), name, seconds, threading.current_thread().name))
+
+    def summary(self, recent = 500) -> dict:
+        """
+        Return stage -> (count, last, mean, maximum) seconds over the most recent events.
+        """
+        with self.lock:
+            events = list(self.events)[-recent:]
+        stages = {}
+        for _, name, seconds, _ in events:
+            stages.setdefault(name, []).append(seconds)
+        return {name: (len(durations), durations[-1], sum(durations) / len(durations), max(durations))
+                for name, durations in stages.items()}
+
+    def write_log(self, fn, caches = None):
+        """
+        Write the events, then the given name -> CacheStats, as json lines.
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(fn, 'w') as f:
+            for wall, name, seconds, thread in events:
+                f.write(json.dumps({'type': 'stage', 'time': wall, 'stage': name,
+                                    'seconds': seconds, 'thread': thread}) + '\n')
+            for name, stats in (caches or {}).items():
+                f.write(json.dumps(dict(stats._asdict(), type = 'cache', cache = name, time = time.time())) + '\n')
+
+# stage timings of the whole process
+timings = Timings()